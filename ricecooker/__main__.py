@@ -1,5 +1,5 @@
 
-"""Usage: ricecooker uploadchannel [-huv] <file_path> [--warn] [--compress] [--token=<t>] [--download-attempts=<n>] [--resume [--step=<step>] | --reset] [--prompt] [--publish] [[OPTIONS] ...]
+"""Usage: ricecooker uploadchannel [-huv] <file_path> [--warn] [--compress] [--token=<t>] [--download-attempts=<n>] [--download-workers=<n>] [--upload-workers=<n>] [--pipeline] [--resume [--step=<step>] | --reset] [--prompt] [--publish] [[OPTIONS] ...]
 
 Arguments:
   file_path        Path to file with channel data
@@ -12,6 +12,9 @@ Options:
   --compress                  Compress high resolution videos to low resolution videos
   --token=<t>                 Authorization token (can be token or path to file with token) [default: #]
   --download-attempts=<n>     Maximum number of times to retry downloading files [default: 3]
+  --download-workers=<n>      Number of files to download in parallel [default: 1]
+  --upload-workers=<n>        Number of files to upload in parallel [default: 1]
+  --pipeline                  Upload files while other files are still downloading
   --resume                    Resume from ricecooker step (cannot be used with --reset flag)
   --step=<step>               Step to resume progress from (must be used with --resume flag) [default: last]
   --reset                     Restart session, overwriting previous session (cannot be used with --resume flag)
@@ -66,11 +69,21 @@ if __name__ == '__main__':
     except ValueError:
       raise InvalidUsageException("Invalid argument: Download-attempts must be an integer.")
 
+    # Make sure worker counts are positive integers
+    for option in ['--download-workers', '--upload-workers']:
+      try:
+        assert int(arguments[option]) > 0
+      except (ValueError, AssertionError):
+        raise InvalidUsageException("Invalid argument: {0} must be a positive integer.".format(option.lstrip('-').capitalize()))
+
 
     uploadchannel(arguments["<file_path>"],
                   verbose=arguments["-v"],
                   update=arguments['-u'],
                   download_attempts=arguments['--download-attempts'],
+                  download_workers=arguments['--download-workers'],
+                  upload_workers=arguments['--upload-workers'],
+                  pipeline=arguments['--pipeline'],
                   resume=arguments['--resume'],
                   reset=arguments['--reset'],
                   token=arguments['--token'],
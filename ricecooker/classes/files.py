@@ -3,23 +3,57 @@ from __future__ import unicode_literals
 
 import os
 import hashlib
+import json
 import tempfile
 import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 import youtube_dl
 import requests
 import zipfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not available on Windows
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
 from subprocess import CalledProcessError
 from le_utils.constants import content_kinds,file_formats, format_presets, exercises
 from .. import config
 from .nodes import ChannelNode, TopicNode, VideoNode, AudioNode, DocumentNode, ExerciseNode, HTML5AppNode
 from ..exceptions import UnknownFileTypeError
-from cachecontrol.caches.file_cache import FileCache
-from pressurecooker.videos import extract_thumbnail_from_video, guess_video_preset_by_resolution, compress_video
+from ..utils.caching import SQLiteCache
+from ..utils.hashing import hash_file
+from ..utils.throttling import Throttle
+from pressurecooker.videos import extract_thumbnail_from_video, compress_video
 from pressurecooker.encodings import get_base64_encoding, write_base64_to_file
-from requests.exceptions import MissingSchema, HTTPError, ConnectionError, InvalidURL, InvalidSchema
+from requests.exceptions import MissingSchema, HTTPError, ConnectionError, InvalidURL, InvalidSchema, ChunkedEncodingError
+from urllib.parse import urlparse
 
-# Cache for filenames
-FILECACHE = FileCache(config.FILECACHE_DIRECTORY, forever=True)
+# ioctl request for cloning a file on copy-on-write filesystems (Linux)
+FICLONE = 0x40049409
+
+# Cache for filenames (entries from older file-based caches are migrated on lookup)
+FILECACHE = SQLiteCache(config.FILECACHE_DATABASE, legacy_directory=config.FILECACHE_DIRECTORY)
+
+# Videos being compressed in background, keyed by compression key
+COMPRESSION_EXECUTOR = None
+COMPRESSION_JOBS = {}
+COMPRESSION_LOCK = threading.Lock()
+
+# YoutubeDL instances kept by each download worker, and limits on downloads from each site
+YOUTUBE_DL_INSTANCES = threading.local()
+WEB_VIDEO_THROTTLE = None
+WEB_VIDEO_THROTTLE_LOCK = threading.Lock()
+
+# Locks for urls being downloaded (workers downloading the same url share its partial download)
+# Each url's lock is kept with the number of workers holding or waiting for it, and dropped once there are none
+DOWNLOAD_LOCKS = {}
+DOWNLOAD_LOCKS_LOCK = threading.Lock()
+
+# Bytes to read from a download at a time (a chunk being read when the connection drops is lost)
+DOWNLOAD_CHUNK_SIZE = 65536
 
 def generate_key(action, path_or_id, settings=None, default=" (default)"):
     """ generate_key: generate key used for caching
@@ -33,51 +67,110 @@ def generate_key(action, path_or_id, settings=None, default=" (default)"):
     settings = " {}".format(str(sorted(settings.items()))) if settings else default
     return "{}: {}{}".format(action.upper(), path_or_id, settings)
 
+def generate_download_key(path):
+    """ generate_download_key: generate key used for caching downloaded files
+        Args: path (str): url or local path of file
+        Returns: key
+    """
+    return "DOWNLOAD:{}".format(path)
+
+def generate_compression_key(filename, ffmpeg_settings):
+    """ generate_compression_key: generate key used for caching compressed videos
+        Args:
+            filename (str): name of uncompressed video in storage directory
+            ffmpeg_settings (dict): settings for compression passed in by user
+        Returns: key
+    """
+    return generate_key("COMPRESSED", filename, settings=ffmpeg_settings or {}, default=" (default compression)")
+
+def generate_skip_compression_key(filename, ffmpeg_settings):
+    """ generate_skip_compression_key: generate key used for caching that video already meets compression target
+        Key includes config's compression targets, so videos are checked again if targets change
+        Args:
+            filename (str): name of uncompressed video in storage directory
+            ffmpeg_settings (dict): settings for compression passed in by user
+        Returns: key
+    """
+    target = "{} (max height {}, max bitrate {})".format(filename, config.COMPRESSION_MAX_HEIGHT, config.COMPRESSION_MAX_BITRATE)
+    return generate_key("SKIPPED COMPRESSION", target, settings=ffmpeg_settings or {}, default=" (default compression)")
+
 def download(path, default_ext=None):
     """ download: downloads file
         Args: None
         Returns: filename
     """
-    key = "DOWNLOAD:{}".format(path)
-    if not config.UPDATE and FILECACHE.get(key):
-        return FILECACHE.get(key).decode('utf-8')
+    key = generate_download_key(path)
+    cached = FILECACHE.get(key)
+    if not config.UPDATE and cached:
+        return cached.decode('utf-8')
 
     config.LOGGER.info("\tDownloading {}".format(path))
 
-    # Write file to temporary file
-    with tempfile.TemporaryFile() as tempf:
-        hash = write_and_get_hash(path, tempf)
-        tempf.seek(0)
-
-        # Get extension of file or default if none found
-        extension = os.path.splitext(path)[1][1:].lower()
-        if extension not in [key for key, value in file_formats.choices]:
-            if default_ext:
-                extension = default_ext
-            else:
-                raise IOError("No extension found: {}".format(path))
+    # Get extension of file or default if none found
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension not in [key for key, value in file_formats.choices]:
+        if default_ext:
+            extension = default_ext
+        else:
+            raise IOError("No extension found: {}".format(path))
 
-        filename = '{0}.{ext}'.format(hash.hexdigest(), ext=extension)
+    # Local files can be placed in storage without copying them through python
+    if os.path.isfile(path):
+        assert os.path.getsize(path) > 0, "File failed to write (corrupted)."
+        filename = "{}.{}".format(get_local_file_hash(path), extension)
+        link_to_storage(path, filename)
+        FILECACHE.set(key, bytes(filename, "utf-8"))
+        return filename
 
-        copy_file_to_storage(filename, tempf)
+    # Remote files are downloaded into a partial file in storage, which is resumed if the download is interrupted
+    if urlparse(path).scheme in ('http', 'https'):
+        with get_download_lock(path):
+            cached = FILECACHE.get(key)
+            if not config.UPDATE and cached:
+                return cached.decode('utf-8') # Another worker downloaded url in the meantime
+
+            # When updating, ask server if a file downloaded before has changed instead of downloading it again
+            revalidate = bool(cached) and os.path.isfile(config.get_storage_path(cached.decode('utf-8')))
+            partial_path = get_partial_download_path(path, extension)
+            hash = download_with_resume(path, partial_path, revalidate=revalidate)
+            if hash is None:
+                config.LOGGER.info("\t--- Not modified {}".format(path))
+                return cached.decode('utf-8')
+            filename = move_to_storage(partial_path, extension, hash=hash)
+            FILECACHE.set(key, bytes(filename, "utf-8"))
+            return filename
 
-        FILECACHE.set(key, bytes(filename, "utf-8"))
+    # Write file straight into storage, hashing it on the way
+    tempf = create_storage_tempfile(extension)
+    try:
+        with tempf:
+            hash = write_and_get_hash(path, tempf)
+        filename = move_to_storage(tempf.name, extension, hash=hash)
+    finally:
+        remove_tempfile(tempf.name)
 
-        return filename
+    FILECACHE.set(key, bytes(filename, "utf-8"))
+    return filename
 
 def write_and_get_hash(path, write_to_file, hash=None):
     """ write_and_get_hash: write file
-        Args: None
+        Args:
+            path (str): url or local path of file
+            write_to_file (file): file to write contents to
+            hash (hash): hash to add contents to (optional)
         Returns: Hash of file's contents
     """
     hash = hash or hashlib.md5()
     try:
         # Access path
         r = config.DOWNLOAD_SESSION.get(path, stream=True)
-        r.raise_for_status()
-        for chunk in r:
-            write_to_file.write(chunk)
-            hash.update(chunk)
+        try:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=2097152):
+                write_to_file.write(chunk)
+                hash.update(chunk)
+        finally:
+            r.close()
 
     except (MissingSchema, InvalidSchema):
         # If path is a local file path, try to open the file (generate hash if none provided)
@@ -90,71 +183,554 @@ def write_and_get_hash(path, write_to_file, hash=None):
 
     return hash
 
-def copy_file_to_storage(filename, srcfile, delete_original=False):
-    # Some files might have been closed, so only filepath will work
-    if isinstance(srcfile, str):
-        srcfile = open(srcfile, 'rb')
+@contextmanager
+def get_download_lock(url):
+    """ get_download_lock: hold lock for downloading url (use in a with statement)
+        Args: url (str): url of file
+        Returns: context manager that holds url's lock
+    """
+    with DOWNLOAD_LOCKS_LOCK:
+        entry = DOWNLOAD_LOCKS.setdefault(url, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with DOWNLOAD_LOCKS_LOCK:
+            entry[1] -= 1
+            if not entry[1]:
+                del DOWNLOAD_LOCKS[url]
+
+def get_partial_download_path(url, extension):
+    """ get_partial_download_path: get path to keep partially downloaded url at between attempts (and runs)
+        Args:
+            url (str): url of file
+            extension (str): extension of file
+        Returns: path to partial file in storage directory
+    """
+    os.makedirs(config.STORAGE_DIRECTORY, exist_ok=True)
+    name = hashlib.md5(url.encode('utf-8')).hexdigest()
+    return os.path.join(config.STORAGE_DIRECTORY, "{}.{}.part".format(name, extension))
+
+def download_with_resume(url, partial_path, revalidate=False):
+    """ download_with_resume: download url to partial_path, resuming interrupted downloads with Range requests
+        Downloads are only resumed if the server sent an ETag or Last-Modified header for the partial
+        content, which is sent back as If-Range so that the server sends the whole file again if it changed
+        Args:
+            url (str): url of file
+            partial_path (str): path to write file to (see get_partial_download_path)
+            revalidate (bool): make request conditional on url having changed since last download (optional)
+        Returns: Hash of file's contents (None if url hasn't changed)
+    """
+    partial_key = "PARTIAL:{}".format(url)
+    attempt = 1
+    while True:
+        headers = get_validation_headers(url) if revalidate else {}
+        cached = FILECACHE.get(partial_key)
+        offset = os.path.getsize(partial_path) if cached and os.path.isfile(partial_path) else 0
+        if offset:
+            headers['Range'] = "bytes={}-".format(offset)
+            headers['If-Range'] = cached.decode('utf-8')
 
-    # Write file to local storage
-    with open(config.get_storage_path(filename), 'wb') as destf:
-        if delete_original:
-            shutil.move(srcfile.name, destf.name)
-        else:
-            shutil.copyfileobj(srcfile, destf)
+        try:
+            r = config.DOWNLOAD_SESSION.get(url, stream=True, headers=headers)
+            try:
+                if r.status_code == 304:
+                    return None
+                if r.status_code == 416 and offset:
+                    FILECACHE.delete(partial_key) # Partial file doesn't match server's file, so start over
+                    continue
+                r.raise_for_status()
+
+                if r.status_code == 206:
+                    config.LOGGER.info("\t--- Resuming download at byte {}".format(offset))
+                    total = get_range_total(r, offset)
+                else:
+                    offset = 0 # Server sent whole file (ranges not supported or file has changed)
+                    total = None if is_encoded(r) else r.headers.get('Content-Length')
+                    set_partial_validator(partial_key, r)
+
+                with open(partial_path, 'r+b' if offset else 'wb') as fobj:
+                    # Hash what was already downloaded before adding new contents
+                    hash = hashlib.md5()
+                    while fobj.tell() < offset:
+                        hash.update(fobj.read(min(2097152, offset - fobj.tell())))
+                    fobj.truncate()
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fobj.write(chunk)
+                        hash.update(chunk)
+                    size = fobj.tell()
+            finally:
+                r.close()
+
+        except (ConnectionError, ChunkedEncodingError) as e:
+            if attempt >= config.DOWNLOAD_ATTEMPTS:
+                raise
+            attempt += 1
+            config.LOGGER.warning("\t--- Download of {} interrupted ({}), retrying".format(url, e))
+            continue
+
+        FILECACHE.delete(partial_key)
+        if total is not None and size != int(total):
+            os.unlink(partial_path)
+            raise IOError("Downloaded {} bytes of {} ({} bytes expected)".format(size, url, total))
+        assert size > 0, "File failed to write (corrupted)."
+        set_validation_headers(url, r)
+        return hash
+
+def get_range_total(response, offset):
+    """ get_range_total: check that partial content starts where download was interrupted
+        Args:
+            response (Response): 206 response to Range request
+            offset (int): number of bytes already downloaded
+        Returns: total size of file (None if server didn't send it)
+    """
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        start, total = content_range.split(' ', 1)[1].split('-', 1)[0], content_range.rsplit('/', 1)[1]
+    except IndexError:
+        raise IOError("Invalid Content-Range for partial download: {}".format(content_range))
+    if int(start) != offset:
+        raise IOError("Partial download starts at byte {} instead of {}".format(start, offset))
+    return None if total == '*' else total
+
+def set_partial_validator(partial_key, response):
+    """ set_partial_validator: save validator to resume partial download of response with
+        Weak ETags can't be used for Range requests, so Last-Modified is used for those instead
+        Args:
+            partial_key (str): key to save validator under
+            response (Response): response to download
+        Returns: None
+    """
+    if is_encoded(response):
+        FILECACHE.delete(partial_key) # Ranges of compressed responses don't line up with decoded contents
+        return
+    etag = response.headers.get('ETag')
+    validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+    if validator:
+        FILECACHE.set(partial_key, bytes(validator, "utf-8"))
+    else:
+        FILECACHE.delete(partial_key)
+
+def get_validation_headers(url):
+    """ get_validation_headers: get headers to only download url if it changed since last download
+        Args: url (str): url of file
+        Returns: dict of If-None-Match/If-Modified-Since headers
+    """
+    cached = FILECACHE.get("VALIDATORS:{}".format(url))
+    validators = json.loads(cached.decode('utf-8')) if cached else {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def set_validation_headers(url, response):
+    """ set_validation_headers: save ETag/Last-Modified headers from downloading url
+        Args:
+            url (str): url of file
+            response (Response): response from downloading url
+        Returns: None
+    """
+    validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    if any(validators.values()):
+        FILECACHE.set("VALIDATORS:{}".format(url), bytes(json.dumps(validators), "utf-8"))
+
+def is_encoded(response):
+    """ is_encoded: check if response was compressed for transfer (e.g. gzip)
+        Args: response (Response): response to check
+        Returns: bool
+    """
+    return response.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+
+def create_storage_tempfile(extension):
+    """ create_storage_tempfile: creates file to write to before its checksum is known
+        File is created in storage directory so it can be renamed into place without copying
+        Args: extension (str): extension of file being written
+        Returns: open temporary file (not deleted when closed)
+    """
+    os.makedirs(config.STORAGE_DIRECTORY, exist_ok=True)
+    return tempfile.NamedTemporaryFile(suffix=".{}".format(extension), dir=config.STORAGE_DIRECTORY, delete=False)
+
+def move_to_storage(tempname, extension, hash=None):
+    """ move_to_storage: renames temporary file to its checksum in storage directory
+        Args:
+            tempname (str): path to temporary file (from create_storage_tempfile)
+            extension (str): extension to give file
+            hash (hash): hash of file's contents if already computed (optional)
+        Returns: filename
+    """
+    filename = "{}.{}".format(hash.hexdigest() if hash else get_hash(tempname), extension)
+    os.replace(tempname, config.get_storage_path(filename))
+    return filename
+
+def link_to_storage(path, filename):
+    """ link_to_storage: places local file in storage directory without copying it where possible
+        Tries a copy-on-write clone (reflink) first, then a hardlink (if config.HARDLINK_LOCAL_FILES
+        is set), then a regular copy (which uses sendfile/fcopyfile where the platform has them)
+        Args:
+            path (str): path to local file
+            filename (str): name to give file in storage directory
+        Returns: None
+    """
+    storage_path = config.get_storage_path(filename)
+    if os.path.isfile(storage_path):
+        return
+
+    if config.HARDLINK_LOCAL_FILES:
+        try:
+            os.link(path, storage_path)
+            return
+        except FileExistsError:
+            return
+        except OSError:
+            pass  # e.g. path is on a different filesystem
+
+    tempf = create_storage_tempfile(os.path.splitext(filename)[1][1:])
+    try:
+        with tempf, open(path, 'rb') as srcf:
+            try:
+                fcntl.ioctl(tempf.fileno(), FICLONE, srcf.fileno())
+                cloned = True
+            except (AttributeError, OSError):
+                cloned = False # Filesystem (or platform) doesn't support cloning files
+        if not cloned:
+            shutil.copyfile(path, tempf.name)
+        os.replace(tempf.name, storage_path)
+    finally:
+        remove_tempfile(tempf.name)
+
+def remove_tempfile(tempname):
+    """ remove_tempfile: deletes temporary file if it hasn't been moved to storage
+        Args: tempname (str): path to temporary file
+        Returns: None
+    """
+    if os.path.exists(tempname):
+        os.unlink(tempname)
 
 def get_hash(filepath):
-    hash = hashlib.md5()
-    with open(filepath, 'rb') as fobj:
-        for chunk in iter(lambda: fobj.read(2097152), b""):
-            hash.update(chunk)
-    return hash.hexdigest()
+    return hash_file(filepath).hexdigest()
+
+def get_local_file_hash(filepath):
+    """ get_local_file_hash: hashes local file, reusing checksum from earlier runs if file hasn't changed
+        Checksums are cached with the file's size, modification time and inode, so any change to
+        the file means it gets hashed again
+        Args: filepath (str): path to local file
+        Returns: MD5 checksum of file
+    """
+    stat = os.stat(filepath)
+    signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    key = "HASH: {}".format(os.path.abspath(filepath))
+
+    cached = FILECACHE.get(key)
+    if cached:
+        entry = json.loads(cached.decode('utf-8'))
+        if entry['stat'] == signature:
+            return entry['md5']
+
+    md5 = hash_file(filepath).hexdigest()
+    FILECACHE.set(key, bytes(json.dumps({'stat': signature, 'md5': md5}), "utf-8"))
+    return md5
+
+
+def probe_video(filename):
+    """ probe_video: get video's resolution, duration, codec and bitrate
+        Results are cached by the video's name in storage (its checksum), so each video
+        only gets probed by ffprobe once, even across runs
+        Args: filename (str): name of video in storage directory
+        Returns: dict of width, height, duration, codec and bitrate (None if video couldn't be probed)
+    """
+    key = "PROBE: {}".format(filename)
+    cached = FILECACHE.get(key)
+    if cached:
+        return json.loads(cached.decode('utf-8'))
+
+    try:
+        result = subprocess.check_output(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_entries',
+                                          'format=duration,bit_rate:stream=codec_type,codec_name,width,height',
+                                          config.get_storage_path(filename)])
+        info = json.loads(result.decode('utf-8'))
+    except (OSError, CalledProcessError, ValueError):
+        return None # ffprobe isn't installed or couldn't read video (not cached, so it's probed again next time)
+
+    video = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    fmt = info.get('format', {})
+    probe = {
+        'width': int(video['width']) if video.get('width') else None,
+        'height': int(video['height']) if video.get('height') else None,
+        'duration': float(fmt['duration']) if fmt.get('duration') else None,
+        'codec': video.get('codec_name'),
+        'bitrate': int(fmt['bit_rate']) if fmt.get('bit_rate') else None,
+    }
+    FILECACHE.set(key, bytes(json.dumps(probe), "utf-8"))
+    return probe
+
+def guess_video_preset(filename):
+    """ guess_video_preset: get preset for video from its resolution
+        Args: filename (str): name of video in storage directory
+        Returns: high resolution preset for videos at least 720 pixels high, otherwise low resolution preset
+    """
+    probe = probe_video(filename)
+    if probe is None or (probe['height'] or 0) >= 720:
+        return format_presets.VIDEO_HIGH_RES
+    return format_presets.VIDEO_LOW_RES
+
+def extract_thumbnail(video_path, thumbnail_path):
+    """ extract_thumbnail: extract frame from middle of video as thumbnail
+        Videos in storage use their cached probe for the duration, and ffmpeg seeks on its
+        input to the nearest keyframe instead of decoding the video up to the middle
+        Args:
+            video_path (str): path to video
+            thumbnail_path (str): path to write png to
+        Returns: None
+    """
+    filename = os.path.basename(video_path)
+    probe = None
+    if os.path.abspath(config.get_storage_path(filename)) == os.path.abspath(video_path):
+        probe = probe_video(filename)
+    if not probe or not probe['duration']:
+        extract_thumbnail_from_video(video_path, thumbnail_path, overwrite=True)
+        return
+
+    subprocess.call(['ffmpeg', '-y', '-noaccurate_seek', '-ss', str(probe['duration'] / 2), '-i', video_path,
+                     '-vframes', '1', '-vcodec', 'png', '-nostats', '-loglevel', 'panic', thumbnail_path])
+
+def plan_compression(filename, ffmpeg_settings):
+    """ plan_compression: decide whether video needs to be compressed
+        Videos that already meet the compression target would come out about the same size
+        (or bigger) and lose quality, so they're kept as they are. This decision is cached
+        (along with the targets it was made against), so it's only made once per video and settings.
+        Args:
+            filename (str): name of video in storage directory
+            ffmpeg_settings (dict): settings for compression passed in by user
+        Returns: dict of whether to 'compress', current 'size' and 'projected_size' after compression (None if unknown)
+    """
+    size = os.path.getsize(config.get_storage_path(filename))
+    skip_key = generate_skip_compression_key(filename, ffmpeg_settings)
+    if not config.UPDATE and FILECACHE.get(skip_key):
+        return {'compress': False, 'size': size, 'projected_size': size}
+    cached = FILECACHE.get(generate_compression_key(filename, ffmpeg_settings))
+    if not config.UPDATE and cached and os.path.isfile(config.get_storage_path(cached.decode('utf-8'))):
+        return {'compress': True, 'size': size, 'projected_size': os.path.getsize(config.get_storage_path(cached.decode('utf-8')))}
+
+    probe = probe_video(filename) or {}
+    max_width = (ffmpeg_settings or {}).get('max_width')
+    if max_width:
+        within_size = bool(probe.get('width')) and probe['width'] <= int(max_width)
+    else:
+        within_size = bool(probe.get('height')) and probe['height'] <= config.COMPRESSION_MAX_HEIGHT
+    within_bitrate = bool(probe.get('bitrate')) and probe['bitrate'] <= config.COMPRESSION_MAX_BITRATE
+
+    if probe.get('codec') == 'h264' and within_size and within_bitrate:
+        FILECACHE.set(skip_key, bytes(filename, "utf-8"))
+        return {'compress': False, 'size': size, 'projected_size': size}
+    projected_size = min(size, int(probe['duration'] * config.COMPRESSION_MAX_BITRATE / 8)) if probe.get('duration') else None
+    return {'compress': True, 'size': size, 'projected_size': projected_size}
+
+def get_compression_workers():
+    """ get_compression_workers: get number of videos to compress at once
+        Uses config.COMPRESSION_WORKERS if set, otherwise sized to the number of CPUs and available memory
+        Args: None
+        Returns: number of workers
+    """
+    if config.COMPRESSION_WORKERS:
+        return config.COMPRESSION_WORKERS
+    workers = max(1, (os.cpu_count() or 1) // config.COMPRESSION_CPUS_PER_JOB)
+    available = get_available_memory()
+    if available is not None:
+        workers = min(workers, max(1, available // config.COMPRESSION_MEMORY_PER_JOB))
+    return workers
+
+def get_available_memory(meminfo_path='/proc/meminfo'):
+    """ get_available_memory: get amount of memory that can be used without swapping
+        Reads MemAvailable on Linux, as free memory leaves out page cache that would be reclaimed
+        Args: meminfo_path (str): path to meminfo file (optional)
+        Returns: number of bytes (None if it can't be read on this platform)
+    """
+    try:
+        with open(meminfo_path) as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024 # Listed in kB
+    except (IOError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
 
+def schedule_compression(filename, ffmpeg_settings):
+    """ schedule_compression: compress video in background
+        Each job runs ffmpeg in its own process, so a thread pool is enough to run several at once
+        Args:
+            filename (str): name of video in storage directory
+            ffmpeg_settings (dict): settings for compression passed in by user
+        Returns: Future of compressed video's filename
+    """
+    global COMPRESSION_EXECUTOR
+    key = generate_compression_key(filename, ffmpeg_settings)
+    with COMPRESSION_LOCK:
+        # Videos used by several nodes are only compressed once
+        if key in COMPRESSION_JOBS:
+            return COMPRESSION_JOBS[key]
+        if COMPRESSION_EXECUTOR is None:
+            COMPRESSION_EXECUTOR = ThreadPoolExecutor(max_workers=get_compression_workers())
+        job = COMPRESSION_JOBS[key] = COMPRESSION_EXECUTOR.submit(compress_video_file, filename, ffmpeg_settings)
+    job.add_done_callback(lambda job: forget_compression(key))
+    return job
+
+def forget_compression(key):
+    """ forget_compression: stop sharing finished compression job (later requests are served from cache)
+        Args: key (str): compression key of job
+        Returns: None
+    """
+    with COMPRESSION_LOCK:
+        COMPRESSION_JOBS.pop(key, None)
 
 def compress_video_file(filename, ffmpeg_settings):
     ffmpeg_settings = ffmpeg_settings or {}
-    key = generate_key("COMPRESSED", filename, settings=ffmpeg_settings, default=" (default compression)")
+    key = generate_compression_key(filename, ffmpeg_settings)
 
-    if not config.UPDATE and FILECACHE.get(key):
-        return FILECACHE.get(key).decode('utf-8')
+    cached = FILECACHE.get(key)
+    if not config.UPDATE and cached:
+        return cached.decode('utf-8')
 
     config.LOGGER.info("\t--- Compressing {}".format(filename))
 
-    tempf = tempfile.NamedTemporaryFile(suffix=".{}".format(file_formats.MP4), delete=False)
+    tempf = create_storage_tempfile(file_formats.MP4)
     tempf.close() # Need to close so pressure cooker can write to file
-    compress_video(config.get_storage_path(filename), tempf.name, overwrite=True, **ffmpeg_settings)
-    filename = "{}.{}".format(get_hash(tempf.name), file_formats.MP4)
+    try:
+        compress_video(config.get_storage_path(filename), tempf.name, overwrite=True, **ffmpeg_settings)
+        filename = move_to_storage(tempf.name, file_formats.MP4)
+    finally:
+        remove_tempfile(tempf.name)
+    probe_video(filename)
 
-    copy_file_to_storage(filename, tempf.name)
-    os.unlink(tempf.name)
     FILECACHE.set(key, bytes(filename, "utf-8"))
     return filename
 
 def download_from_web(web_url, download_settings):
     key = generate_key("DOWNLOADED", web_url, settings=download_settings)
-    if not config.UPDATE and FILECACHE.get(key):
-        return FILECACHE.get(key).decode('utf-8')
-
-    # Get hash of web_url to act as temporary storage name
-    url_hash = hashlib.md5()
-    url_hash.update(web_url.encode('utf-8'))
-    destination_path = os.path.join(tempfile.gettempdir(), "{}.{}".format(url_hash.hexdigest(), file_formats.MP4))
-    download_settings["outtmpl"] = destination_path
-    try:
-        os.remove(destination_path)
-    except Exception:
-        pass
-
-    with youtube_dl.YoutubeDL(download_settings) as ydl:
-        ydl.download([web_url])
-        filename = "{}.{}".format(get_hash(destination_path), file_formats.MP4)
+    cached = FILECACHE.get(key)
+    if not config.UPDATE and cached:
+        return cached.decode('utf-8')
+
+    # Workers downloading the same video share its temporary file, so only one downloads it at a time
+    with get_download_lock(web_url):
+        cached = FILECACHE.get(key)
+        if not config.UPDATE and cached:
+            return cached.decode('utf-8') # Another worker downloaded video in the meantime
+
+        # Get hash of web_url to act as temporary storage name
+        # (downloaded into storage directory so it can be renamed into place)
+        url_hash = hashlib.md5()
+        url_hash.update(web_url.encode('utf-8'))
+        os.makedirs(config.STORAGE_DIRECTORY, exist_ok=True)
+        destination_path = os.path.join(config.STORAGE_DIRECTORY, "{}.{}".format(url_hash.hexdigest(), file_formats.MP4))
+        remove_tempfile(destination_path)
 
-        # Write file to local storage
-        with open(destination_path, "rb") as dlf, open(config.get_storage_path(filename), 'wb') as destf:
-            shutil.copyfileobj(dlf, destf)
+        try:
+            run_youtube_dl(web_url, download_settings, destination_path)
+            filename = move_to_storage(destination_path, file_formats.MP4)
+        finally:
+            remove_tempfile(destination_path)
+        probe_video(filename)
 
         FILECACHE.set(key, bytes(filename, "utf-8"))
         return filename
 
+def get_youtube_dl(settings):
+    """ get_youtube_dl: get this thread's YoutubeDL for settings, reusing it between downloads
+        Extractors keep state between downloads (e.g. YouTube's deciphered signature
+        functions), so reusing instances saves setting them up again for every video
+        Args: settings (dict): youtube_dl options (outtmpl is set for each download)
+        Returns: YoutubeDL
+    """
+    instances = YOUTUBE_DL_INSTANCES.__dict__.setdefault('instances', {})
+    key = str(sorted((option, value) for option, value in settings.items() if option != 'outtmpl'))
+    if key not in instances:
+        instances[key] = youtube_dl.YoutubeDL(dict(settings))
+    return instances[key]
+
+def run_youtube_dl(url, settings, outtmpl):
+    """ run_youtube_dl: download url with youtube_dl, limiting how many downloads each site gets at once
+        Args:
+            url (str): url of video page
+            settings (dict): youtube_dl options
+            outtmpl (str): path to download to
+        Returns: None
+    """
+    global WEB_VIDEO_THROTTLE
+    with WEB_VIDEO_THROTTLE_LOCK:
+        if WEB_VIDEO_THROTTLE is None:
+            WEB_VIDEO_THROTTLE = Throttle(concurrency=config.WEB_VIDEO_HOST_CONNECTIONS, delay=config.WEB_VIDEO_HOST_DELAY)
+        throttle = WEB_VIDEO_THROTTLE
+
+    host = urlparse(url).netloc
+    ydl = get_youtube_dl(settings)
+    ydl.params['outtmpl'] = outtmpl
+    throttle.acquire(host)
+    try:
+        ydl.download([url])
+    finally:
+        throttle.release(host)
+
+def generate_subtitle_key(youtube_id, language):
+    """ generate_subtitle_key: generate key used for caching YouTube subtitles
+        Args:
+            youtube_id (str): id of YouTube video
+            language (str): language of subtitles
+        Returns: key
+    """
+    return "DOWNLOADED YOUTUBE {}-{}".format(youtube_id, language)
+
+def download_youtube_subtitles(youtube_id, languages):
+    """ download_youtube_subtitles: download subtitles for several languages with one extraction
+        Args:
+            youtube_id (str): id of YouTube video
+            languages ([str]): languages of subtitles to download
+        Returns: dict of languages mapped to filenames (languages YouTube doesn't have are left out)
+    """
+    # Workers getting subtitles for the same video share their temporary files, so only one extracts them at a time
+    with get_download_lock(youtube_id):
+        filenames = {}
+        for lang in languages:
+            cached = FILECACHE.get(generate_subtitle_key(youtube_id, lang))
+            if not config.UPDATE and cached:
+                filenames[lang] = cached.decode('utf-8') # Another worker downloaded subtitles in the meantime
+        languages = [lang for lang in languages if lang not in filenames]
+        if not languages:
+            return filenames
+
+        url_hash = hashlib.md5()
+        url_hash.update(youtube_id.encode('utf-8'))
+        os.makedirs(config.STORAGE_DIRECTORY, exist_ok=True)
+        destination_path = os.path.join(config.STORAGE_DIRECTORY, "{}".format(url_hash.hexdigest()))
+        download_paths = {lang: "{destpath}.{lang}.{ext}".format(destpath=destination_path, lang=lang, ext=file_formats.VTT) for lang in languages}
+
+        settings = {
+            'skip_download': True,
+            'writesubtitles': True,
+            'subtitleslangs': languages,
+            'subtitlesformat': "best[ext={}]".format(file_formats.VTT),
+            'quiet': True,
+        }
+
+        try:
+            for path in download_paths.values():
+                remove_tempfile(path)
+            run_youtube_dl('http://www.youtube.com/watch?v={}'.format(youtube_id), settings, destination_path)
+            for lang, path in download_paths.items():
+                if os.path.isfile(path):
+                    filenames[lang] = move_to_storage(path, file_formats.VTT)
+                    FILECACHE.set(generate_subtitle_key(youtube_id, lang), bytes(filenames[lang], "utf-8"))
+        finally:
+            for path in download_paths.values():
+                remove_tempfile(path)
+
+        return filenames
+
 class ThumbnailPresetMixin(object):
 
     def get_preset(self):
@@ -191,6 +767,20 @@ class File(object):
     def validate(self):
         pass
 
+    def get_cache_key(self):
+        """ get_cache_key: key under which file's processed filename is cached
+            Args: None
+            Returns: key (None if file isn't cached)
+        """
+        return None
+
+    def get_derived_cache_key(self, filename):
+        """ get_derived_cache_key: key for further processing of file once cached filename is known
+            Args: filename (str): filename cached under get_cache_key
+            Returns: key (None if cached filename is final)
+        """
+        return None
+
     def get_preset(self):
         if self.preset:
             return self.preset
@@ -240,6 +830,9 @@ class DownloadFile(File):
         if len(plain_ext) > 1:
             assert plain_ext in self.allowed_formats, "{} must have one of the following extensions: {} (instead, got '{}' from '{}')".format(self.__class__.__name__, self.allowed_formats, plain_ext, self.path)
 
+    def get_cache_key(self):
+        return generate_download_key(self.path)
+
     def process_file(self):
         try:
             self.filename = download(self.path, default_ext=self.default_ext)
@@ -296,45 +889,93 @@ class ExtractedVideoThumbnailFile(ThumbnailFile):
         config.LOGGER.info("\t--- Extracted thumbnail {}".format(self.filename))
         return self.filename
 
+    def get_cache_key(self):
+        return "EXTRACTED: {}".format(self.path)
+
     def derive_thumbnail(self):
-        key = "EXTRACTED: {}".format(self.path)
-        if not config.UPDATE and FILECACHE.get(key):
-            return FILECACHE.get(key).decode('utf-8')
+        key = self.get_cache_key()
+        cached = FILECACHE.get(key)
+        if not config.UPDATE and cached:
+            return cached.decode('utf-8')
 
         config.LOGGER.info("\t--- Extracting thumbnail from {}".format(self.path))
-        tempf = tempfile.NamedTemporaryFile(suffix=".{}".format(file_formats.PNG), delete=False)
+        tempf = create_storage_tempfile(file_formats.PNG)
         tempf.close()
-        extract_thumbnail_from_video(self.path, tempf.name, overwrite=True)
-        filename = "{}.{}".format(get_hash(tempf.name), file_formats.PNG)
+        try:
+            extract_thumbnail(self.path, tempf.name)
+            filename = move_to_storage(tempf.name, file_formats.PNG)
+        finally:
+            remove_tempfile(tempf.name)
 
-        copy_file_to_storage(filename, tempf.name)
-        os.unlink(tempf.name)
         FILECACHE.set(key, bytes(filename, "utf-8"))
         return filename
 
 class VideoFile(DownloadFile):
     default_ext = file_formats.MP4
     allowed_formats = [file_formats.MP4]
+    defer_compression = False # Return before compression is done (call finish_compression to get compressed video)
+    compression = None # Future of compressed video's filename while video is being compressed
+    compression_plan = None # Whether video needed compressing and its projected size (see plan_compression)
 
     def __init__(self, path, ffmpeg_settings=None, **kwargs):
         self.ffmpeg_settings = ffmpeg_settings
         super(VideoFile, self).__init__(path, **kwargs)
 
     def get_preset(self):
-        return self.preset or guess_video_preset_by_resolution(config.get_storage_path(self.filename))
+        return self.preset or guess_video_preset(self.filename)
+
+    def get_derived_cache_key(self, filename):
+        if self.ffmpeg_settings or config.COMPRESS:
+            return generate_compression_key(filename, self.ffmpeg_settings)
+        return None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('compression', None)
+        return state
 
     def process_file(self):
+        # Get copy of video before compression (if specified), probing it while it's fresh
+        self.filename = super(VideoFile, self).process_file()
+        if not self.filename:
+            return None
+        try:
+            probe_video(self.filename)
+            if not (self.ffmpeg_settings or config.COMPRESS):
+                return self.filename
+            self.compression_plan = plan_compression(self.filename, self.ffmpeg_settings)
+        # Catch errors related to reading video (e.g. storage file has been removed) and handle silently
+        except (BrokenPipeError, CalledProcessError, IOError) as err:
+            self.error = err
+            config.FAILED_FILES.append(self)
+            return None
+
+        if not self.compression_plan['compress']:
+            config.LOGGER.info("\t--- Not compressing {} (already meets target)".format(self.filename))
+            return self.filename
+        if self.compression_plan['projected_size'] is not None:
+            config.LOGGER.info("\t--- Compressing {0} ({1:.1f} MB, projected {2:.1f} MB)".format(self.filename,
+                self.compression_plan['size'] / 1048576, self.compression_plan['projected_size'] / 1048576))
+        self.compression = schedule_compression(self.filename, self.ffmpeg_settings)
+        if self.defer_compression:
+            return None
+        return self.finish_compression()
+
+    def finish_compression(self):
+        """ finish_compression: waits for video to be compressed
+            Args: None
+            Returns: filename of compressed video (None if compression failed)
+        """
         try:
-            # Get copy of video before compression (if specified)
-            self.filename = super(VideoFile, self).process_file()
-            if self.filename and (self.ffmpeg_settings or config.COMPRESS):
-                self.filename = compress_video_file(self.filename, self.ffmpeg_settings)
-                config.LOGGER.info("\t--- Compressed {}".format(self.filename))
+            self.filename = self.compression.result()
+            config.LOGGER.info("\t--- Compressed {}".format(self.filename))
             return self.filename
         # Catch errors related to ffmpeg and handle silently
         except (BrokenPipeError, CalledProcessError, IOError) as err:
             self.error = err
             config.FAILED_FILES.append(self)
+        finally:
+            self.compression = None
 
 
 class WebVideoFile(File):
@@ -350,7 +991,10 @@ class WebVideoFile(File):
         super(WebVideoFile, self).__init__(**kwargs)
 
     def get_preset(self):
-        return self.preset or guess_video_preset_by_resolution(config.get_storage_path(self.filename))
+        return self.preset or guess_video_preset(self.filename)
+
+    def get_cache_key(self):
+        return generate_key("DOWNLOADED", self.web_url, settings=self.download_settings)
 
     def process_file(self):
         try:
@@ -380,40 +1024,26 @@ class YouTubeSubtitleFile(File):
         config.LOGGER.info("\t--- Downloaded subtitle {}".format(self.filename))
         return self.filename
 
-    def download_subtitle(self):
-        key = "DOWNLOADED YOUTUBE {}-{}".format(self.youtube_id, self.language)
-        if not config.UPDATE and FILECACHE.get(key):
-            return FILECACHE.get(key).decode('utf-8')
-
-        url_hash = hashlib.md5()
-        url_hash.update(self.youtube_id.encode('utf-8'))
-        destination_path = os.path.join(tempfile.gettempdir(), "{}".format(url_hash.hexdigest()))
-        try:
-            os.remove(destination_path)
-        except Exception:
-            pass
-
-        settings = {
-            'skip_download': True,
-            'writesubtitles': True,
-            'subtitleslangs': [self.language],
-            'outtmpl': destination_path,
-            'subtitlesformat': "best[ext={}]".format(file_formats.VTT),
-            'quiet': True,
-        }
-
-        with youtube_dl.YoutubeDL(settings) as ydl:
-            ydl.download(['http://www.youtube.com/watch?v={}'.format(self.youtube_id)])
-            youtube_download_path = "{destpath}.{lang}.{ext}".format(destpath=destination_path, lang=self.language, ext=file_formats.VTT)
-
-            filename = "{}.{}".format(get_hash(youtube_download_path), file_formats.VTT)
+    def get_cache_key(self):
+        return generate_subtitle_key(self.youtube_id, self.language)
 
-            # Write file to local storage
-            with open(youtube_download_path, "rb") as dlf, open(config.get_storage_path(filename), 'wb') as destf:
-                shutil.copyfileobj(dlf, destf)
-
-            FILECACHE.set(key, bytes(filename, "utf-8"))
-            return filename
+    def download_subtitle(self):
+        key = self.get_cache_key()
+        cached = FILECACHE.get(key)
+        if not config.UPDATE and cached:
+            return cached.decode('utf-8')
+
+        # Get node's other subtitles for this video in the same extraction
+        siblings = [f for f in (self.node.files if self.node else []) if f is not self and \
+                    isinstance(f, YouTubeSubtitleFile) and f.youtube_id == self.youtube_id and not f.filename]
+        languages = [self.language] + [f.language for f in siblings if f.language != self.language]
+
+        filenames = download_youtube_subtitles(self.youtube_id, list(OrderedDict.fromkeys(languages)))
+        for f in siblings:
+            f.filename = filenames.get(f.language)
+        if self.language not in filenames:
+            raise IOError("No {} subtitles found for YouTube video {}".format(self.language, self.youtube_id))
+        return filenames[self.language]
 
 class SubtitleFile(DownloadFile):
     default_ext = file_formats.VTT
@@ -442,27 +1072,32 @@ class Base64ImageFile(ThumbnailPresetMixin, File):
         config.LOGGER.info("\t--- Converted base64 image to {}".format(self.filename))
         return self.filename
 
-    def convert_base64_to_file(self):
+    def get_cache_key(self):
         # Get hash of content for cache key
         hashed_content = hashlib.md5()
         hashed_content.update(self.encoding.encode('utf-8'))
-        key = "ENCODED: {} (base64 encoded)".format(hashed_content.hexdigest())
+        return "ENCODED: {} (base64 encoded)".format(hashed_content.hexdigest())
+
+    def convert_base64_to_file(self):
+        key = self.get_cache_key()
 
-        if not config.UPDATE and FILECACHE.get(key):
-            return FILECACHE.get(key).decode('utf-8')
+        cached = FILECACHE.get(key)
+        if not config.UPDATE and cached:
+            return cached.decode('utf-8')
 
         config.LOGGER.info("\tConverting base64 to file")
 
         extension = get_base64_encoding(self.encoding).group(1)
         assert extension in [file_formats.PNG, file_formats.JPG, file_formats.JPEG], "Base64 files must be images in jpg or png format"
 
-        tempf = tempfile.NamedTemporaryFile(suffix=".{}".format(extension), delete=False)
+        tempf = create_storage_tempfile(extension)
         tempf.close()
-        write_base64_to_file(self.encoding, tempf.name)
-        filename = "{}.{}".format(get_hash(tempf.name), file_formats.PNG)
+        try:
+            write_base64_to_file(self.encoding, tempf.name)
+            filename = move_to_storage(tempf.name, file_formats.PNG)
+        finally:
+            remove_tempfile(tempf.name)
 
-        copy_file_to_storage(filename, tempf.name)
-        os.unlink(tempf.name)
         FILECACHE.set(key, bytes(filename, "utf-8"))
         return filename
 
@@ -511,31 +1146,35 @@ class _ExerciseGraphieFile(DownloadFile):
             self.error = err
             config.FAILED_FILES.append(self)
 
+    def get_cache_key(self):
+        return "GRAPHIE: {}".format(self.path)
+
     def generate_graphie_file(self):
-        key = "GRAPHIE: {}".format(self.path)
+        key = self.get_cache_key()
 
-        if not config.UPDATE and FILECACHE.get(key):
-            return FILECACHE.get(key).decode('utf-8')
+        cached = FILECACHE.get(key)
+        if not config.UPDATE and cached:
+            return cached.decode('utf-8')
 
         # Create graphie file combining svg and json files
-        with tempfile.TemporaryFile() as tempf:
-            # Initialize hash and files
-            delimiter = bytes(exercises.GRAPHIE_DELIMITER, 'UTF-8')
-            config.LOGGER.info("\tDownloading graphie {}".format(self.original_filename))
-
-
-            # Write to graphie file
-            hash = write_and_get_hash(self.path + ".svg", tempf)
-            tempf.write(delimiter)
-            hash.update(delimiter)
-            hash = write_and_get_hash(self.path + "-data.json", tempf, hash)
-            tempf.seek(0)
-            filename = "{}.{}".format(hash.hexdigest(), file_formats.GRAPHIE)
-
-            copy_file_to_storage(filename, tempf)
+        tempf = create_storage_tempfile(file_formats.GRAPHIE)
+        try:
+            with tempf:
+                # Initialize hash and files
+                delimiter = bytes(exercises.GRAPHIE_DELIMITER, 'UTF-8')
+                config.LOGGER.info("\tDownloading graphie {}".format(self.original_filename))
+
+                # Write to graphie file
+                hash = write_and_get_hash(self.path + ".svg", tempf)
+                tempf.write(delimiter)
+                hash.update(delimiter)
+                hash = write_and_get_hash(self.path + "-data.json", tempf, hash)
+            filename = move_to_storage(tempf.name, file_formats.GRAPHIE, hash=hash)
+        finally:
+            remove_tempfile(tempf.name)
 
-            FILECACHE.set(key, bytes(filename, "utf-8"))
-            return filename
+        FILECACHE.set(key, bytes(filename, "utf-8"))
+        return filename
 
 # VectorizedVideoFile
 # TiledThumbnailFile
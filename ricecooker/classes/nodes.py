@@ -71,7 +71,8 @@ class Node(object):
         """
         filenames = []
         for f in self.files:
-            filenames.append(f.process_file())
+            # Files that have already been processed keep their filename
+            filenames.append(f.get_filename())
         return filenames
 
     def count(self):
@@ -9,6 +9,7 @@ from .classes import nodes, questions
 from requests.exceptions import HTTPError
 from .managers.progress import RestoreManager, Status
 from .managers.tree import ChannelManager
+from .utils.throttling import Throttle, ThrottledHTTPAdapter
 from importlib.machinery import SourceFileLoader
 
 # Fix to support Python 2.x.
@@ -18,13 +19,16 @@ try:
 except NameError:
     pass
 
-def uploadchannel(path, verbose=False, update=False, download_attempts=3, resume=False, reset=False, step=Status.LAST.name, token="#", prompt=False, publish=False, warnings=False, compress=False, **kwargs):
+def uploadchannel(path, verbose=False, update=False, download_attempts=3, download_workers=1, upload_workers=1, pipeline=False, resume=False, reset=False, step=Status.LAST.name, token="#", prompt=False, publish=False, warnings=False, compress=False, **kwargs):
     """ uploadchannel: Upload channel to Kolibri Studio server
         Args:
             path (str): path to file containing construct_channel method
             verbose (bool): indicates whether to print process (optional)
             update (bool): indicates whether to re-download files (optional)
             download_attempts (int): number of times to retry downloading files (optional)
+            download_workers (int): number of files to download in parallel (optional)
+            upload_workers (int): number of files to upload in parallel (optional)
+            pipeline (bool): indicates whether to upload files while other files are still downloading (optional)
             resume (bool): indicates whether to resume last session automatically (optional)
             step (str): step to resume process from (optional)
             reset (bool): indicates whether to start session from beginning automatically (optional)
@@ -47,10 +51,20 @@ def uploadchannel(path, verbose=False, update=False, download_attempts=3, resume
     config.SESSION.headers.update({"Authorization": "Token {0}".format(token)})
     config.UPDATE = update
     config.COMPRESS = compress
+    config.DOWNLOAD_WORKERS = int(download_workers)
+    config.DOWNLOAD_ATTEMPTS = int(download_attempts)
+    config.UPLOAD_WORKERS = int(upload_workers)
 
-    # Set max retries for downloading
-    config.DOWNLOAD_SESSION.mount('http://', requests.adapters.HTTPAdapter(max_retries=int(download_attempts)))
-    config.DOWNLOAD_SESSION.mount('https://', requests.adapters.HTTPAdapter(max_retries=int(download_attempts)))
+    # Set max retries for downloading, and limit how hard each host is hit by download workers
+    throttle = Throttle(concurrency=config.DOWNLOAD_HOST_CONNECTIONS, delay=config.DOWNLOAD_HOST_DELAY)
+    for prefix in ('http://', 'https://'):
+        config.DOWNLOAD_SESSION.mount(prefix, ThrottledHTTPAdapter(throttle=throttle, attempts=config.DOWNLOAD_ATTEMPTS,
+            max_retries=config.DOWNLOAD_ATTEMPTS, pool_connections=config.DOWNLOAD_HOST_POOLS))
+
+    # Share one connection pool between upload workers
+    pool_size = max(requests.adapters.DEFAULT_POOLSIZE, config.UPLOAD_WORKERS)
+    config.SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+    config.SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
 
     # Get domain to upload to
     config.init_file_mapping_store()
@@ -83,9 +97,15 @@ def uploadchannel(path, verbose=False, update=False, download_attempts=3, resume
         config.PROGRESS_MANAGER.set_tree(create_initial_tree(channel))
     tree = config.PROGRESS_MANAGER.tree
 
-    # Download files if they haven't been downloaded already
+    # Download files if they haven't been downloaded already (uploading them along the way if pipelining)
     if config.PROGRESS_MANAGER.get_status_val() <= Status.DOWNLOAD_FILES.value:
-        config.PROGRESS_MANAGER.set_files(*process_tree_files(tree))
+        if pipeline:
+            tree.uploaded_files = config.PROGRESS_MANAGER.files_uploaded
+            files_to_diff, files_failed, file_diff = process_and_upload_tree_files(tree)
+            config.PROGRESS_MANAGER.set_files(files_to_diff, files_failed)
+            config.PROGRESS_MANAGER.set_diff(file_diff)
+        else:
+            config.PROGRESS_MANAGER.set_files(*process_tree_files(tree))
 
     # Set download manager in case steps were skipped
     files_to_diff = config.PROGRESS_MANAGER.files_downloaded
@@ -232,6 +252,18 @@ def process_tree_files(tree):
     tree.check_for_files_failed()
     return files_to_diff, config.FAILED_FILES
 
+def process_and_upload_tree_files(tree):
+    """ process_and_upload_tree_files: Download files from nodes, uploading them as they're downloaded
+        Any files that fail to upload are uploaded again in the uploading step
+        Args:
+            tree (ChannelManager): manager to handle communication to Kolibri Studio
+        Returns: list of files that were downloaded, files that failed, and files that weren't on Kolibri Studio
+    """
+    config.LOGGER.info("Processing and uploading content...")
+    files_to_diff, file_diff = tree.process_and_upload_tree(tree.channel)
+    tree.check_for_files_failed()
+    return files_to_diff, config.FAILED_FILES, file_diff
+
 def get_file_diff(tree, files_to_diff):
     """ get_file_diff: Download files from nodes
         Args:
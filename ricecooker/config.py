@@ -10,6 +10,9 @@ from requests_file import FileAdapter
 
 UPDATE = False
 COMPRESS = False
+DOWNLOAD_WORKERS = 1
+DOWNLOAD_ATTEMPTS = 3
+UPLOAD_WORKERS = 1
 PROGRESS_MANAGER = None
 LOGGER = logging.getLogger()
 
@@ -29,6 +32,9 @@ FILE_DIFF_URL = "{domain}/api/internal/file_diff"
 # URL for uploading files to server
 FILE_UPLOAD_URL = "{domain}/api/internal/file_upload"
 
+# URL for uploading part of a large file to server
+FILE_UPLOAD_CHUNK_URL = "{domain}/api/internal/file_upload_chunk"
+
 # URL for creating channel on server
 CREATE_CHANNEL_URL = "{domain}/api/internal/create_channel"
 
@@ -50,14 +56,78 @@ STORAGE_DIRECTORY = "storage"
 # Folder to store progress tracking information
 RESTORE_DIRECTORY = "restore"
 
+# Hardlink local files into storage directory instead of copying them
+# (only safe if source files aren't modified in place afterwards)
+HARDLINK_LOCAL_FILES = False
+
 # Session for communicating to Kolibri Studio
 SESSION = requests.Session()
 
+# Concurrent file diff requests and bounds for their batch sizes (batches are resized
+# so that each request takes about FILE_DIFF_TARGET_LATENCY seconds)
+FILE_DIFF_WORKERS = 4
+FILE_DIFF_BATCH_SIZE = 1000
+FILE_DIFF_MIN_BATCH_SIZE = 100
+FILE_DIFF_MAX_PAYLOAD = 1024 * 1024
+FILE_DIFF_TARGET_LATENCY = 2.0
+
+# Maximum number of seconds processed files wait to be checked against Kolibri Studio
+# when downloading and uploading are pipelined (or until FILE_DIFF_MIN_BATCH_SIZE are queued)
+PIPELINE_DIFF_INTERVAL = 5.0
+
+# Number of add_nodes requests to send concurrently when creating tree
+ADD_NODES_WORKERS = 4
+
+# Number of uploaded files between progress checkpoints
+UPLOAD_CHECKPOINT_INTERVAL = 50
+
+# Number of changes to record in progress journal before taking a new snapshot
+JOURNAL_SNAPSHOT_INTERVAL = 1000
+
+# Files larger than this (in bytes) are uploaded in resumable chunks, for servers with a
+# file_upload_chunk endpoint (None to always upload whole files). Files are uploaded whole
+# if the server turns out not to support chunked uploads.
+CHUNKED_UPLOAD_THRESHOLD = None
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
 # Cache for filenames
+FILECACHE_DATABASE = ".ricecookerfilecache.sqlite3"
+
+# Directory used to cache filenames by older versions (migrated to FILECACHE_DATABASE)
 FILECACHE_DIRECTORY = ".ricecookerfilecache"
 
 FAILED_FILES = []
 
+# Limits for downloading from each host: requests at once, minimum seconds between
+# requests, and backoff when a host responds 429/503 without a Retry-After header
+DOWNLOAD_HOST_CONNECTIONS = 4
+DOWNLOAD_HOST_DELAY = 0
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_MAX_BACKOFF = 300
+
+# Number of threads ricecooker.utils.aio runs blocking network operations on
+ASYNC_IO_WORKERS = 32
+
+# Limits for downloading web videos (e.g. with youtube_dl) from each site:
+# videos at once and minimum seconds between starting videos
+WEB_VIDEO_HOST_CONNECTIONS = 4
+WEB_VIDEO_HOST_DELAY = 0
+
+# Videos that are already H.264, no taller than COMPRESSION_MAX_HEIGHT (or wider than the
+# max_width compression setting) and at most COMPRESSION_MAX_BITRATE bits per second
+# (including audio) are kept as they are instead of being compressed
+COMPRESSION_MAX_HEIGHT = 480
+COMPRESSION_MAX_BITRATE = 600 * 1000
+
+# Number of videos to compress at once (if None, one per COMPRESSION_CPUS_PER_JOB
+# CPUs, limited by available memory at COMPRESSION_MEMORY_PER_JOB bytes per video)
+COMPRESSION_WORKERS = None
+COMPRESSION_CPUS_PER_JOB = 2
+COMPRESSION_MEMORY_PER_JOB = 512 * 1024 * 1024
+
+# Number of hosts to keep connections open to between downloads
+DOWNLOAD_HOST_POOLS = 32
+
 # Session for downloading files
 DOWNLOAD_SESSION = requests.Session()
 DOWNLOAD_SESSION.mount('file://', FileAdapter())
@@ -70,8 +140,8 @@ def get_storage_path(filename):
     """
     directory = os.path.join(STORAGE_DIRECTORY, filename[0], filename[1])
     # Make storage directory for downloaded files if it doesn't already exist
-    if not os.path.exists(directory) :
-        os.makedirs(directory)
+    # (exist_ok avoids races between download workers creating the same directory)
+    os.makedirs(directory, exist_ok=True)
 
     return os.path.join(directory, filename)
 
@@ -126,6 +196,13 @@ def file_upload_url():
     """
     return FILE_UPLOAD_URL.format(domain=DOMAIN)
 
+def file_upload_chunk_url():
+    """ file_upload_chunk_url: returns url to upload part of a file
+        Args: None
+        Returns: string url to file_upload_chunk endpoint
+    """
+    return FILE_UPLOAD_CHUNK_URL.format(domain=DOMAIN)
+
 def create_channel_url():
     """ create_channel_url: returns url to create channel
         Args: None
@@ -1,9 +1,14 @@
+import json
 import pickle
 import os
 import sys
+import threading
 from enum import Enum
 from .. import config
 
+# Upload workers record progress from their own threads
+PROGRESS_LOCK = threading.RLock()
+
 class Status(Enum):
     """ Enum containing all statuses Ricecooker can have
 
@@ -36,31 +41,48 @@ class Status(Enum):
 class RestoreManager:
     """ Manager for handling resuming rice cooking process
 
+        Progress is saved as a snapshot of the manager when a step is reached, with
+        any changes made during that step appended to the step's journal, which is
+        replayed on top of the snapshot when progress is loaded.
+
         Attributes:
             restore_path (str): path to .pickle file to store progress
             channel (Channel): channel Ricecooker is creating
             tree (ChannelManager): manager Ricecooker is using
             files_downloaded ([str]): list of files that have been downloaded
+            files_processed ({str:str}): filenames of files processed so far, keyed by position in tree
             file_mapping ({filename:...}): filenames mapped to metadata
             files_failed ([str]): list of files that failed to download
             file_diff ([str]): list of files that don't exist on Kolibri Studio
             files_uploaded ([str]): list of files that have been successfully uploaded
+            upload_offsets ({filename:int}): bytes acknowledged by Kolibri Studio for partially uploaded files
             channel_link (str): link to uploaded channel
             channel_id (str): id of channel that has been uploaded
             status (str): status of Ricecooker
+            uploads_recorded (int): number of files_uploaded saved in snapshot or journal
+            journal_length (int): number of changes in journal since last snapshot
     """
 
     def __init__(self):
         self.channel = None
         self.tree = None
         self.files_downloaded = []
+        self.files_processed = {}
         self.file_mapping = {}
         self.files_failed = []
         self.file_diff = []
         self.files_uploaded = []
+        self.upload_offsets = {}
         self.channel_link = None
         self.channel_id = None
         self.status = Status.INIT
+        self.uploads_recorded = 0
+        self.journal_length = 0
+
+    def __setstate__(self, state):
+        # Fill in any attributes missing from sessions saved by older versions
+        self.__init__()
+        self.__dict__.update(state)
 
     def check_for_session(self, status=None):
         """ check_for_session: see if session is in progress
@@ -80,14 +102,82 @@ class RestoreManager:
         status = self.get_status() if status is None else status
         return config.get_restore_path(status.name.lower())
 
+    def get_journal_path(self, status=None):
+        """ get_journal_path: get path to journal of changes made since step's snapshot
+            Args:
+                status (str): step to get journal file (optional)
+            Returns: string path to journal file
+        """
+        return os.path.splitext(self.get_restore_path(status))[0] + '.jsonl'
+
     def record_progress(self):
         """ record_progress: save progress to respective restoration file
             Args: None
             Returns: None
         """
-        with open(self.get_restore_path(Status.LAST), 'wb') as handle, open(self.get_restore_path(), 'wb') as step_handle:
-            pickle.dump(self, handle)
-            pickle.dump(self, step_handle)
+        with PROGRESS_LOCK:
+            self.uploads_recorded = len(self.files_uploaded)
+            self.journal_length = 0
+
+            # Write snapshot atomically so a crash can't leave a truncated file behind
+            path = self.get_restore_path()
+            with open(path + '.tmp', 'wb') as step_handle:
+                pickle.dump(self, step_handle)
+            os.replace(path + '.tmp', path)
+
+            # Changes in journal are now part of snapshot
+            if os.path.isfile(self.get_journal_path()):
+                os.remove(self.get_journal_path())
+
+            # Point last restoration file to this step rather than writing snapshot twice
+            with open(self.get_restore_path(Status.LAST), 'wb') as handle:
+                pickle.dump(self.status.name, handle)
+
+    def record_change(self, change, **data):
+        """ record_change: append change to journal for current step
+            Args:
+                change (str): kind of change (see apply_change)
+                data (dict): data needed to apply change
+            Returns: None
+        """
+        with PROGRESS_LOCK:
+            with open(self.get_journal_path(), 'a') as handle:
+                handle.write(json.dumps(dict(data, change=change)) + "\n")
+            self.journal_length += 1
+
+            # Compact journal into a new snapshot once it gets long (unless files are
+            # being downloaded, as the tree is still being modified by download workers)
+            if self.journal_length >= config.JOURNAL_SNAPSHOT_INTERVAL and self.status != Status.DOWNLOAD_FILES:
+                self.record_progress()
+
+    def apply_change(self, entry):
+        """ apply_change: apply change read from journal
+            Args: entry (dict): change recorded by record_change
+            Returns: None
+        """
+        if entry['change'] == 'processed':
+            self.files_processed[entry['key']] = entry['filename']
+        elif entry['change'] == 'uploaded':
+            self.files_uploaded += entry['files']
+            self.uploads_recorded = len(self.files_uploaded)
+        elif entry['change'] == 'upload_offset':
+            self.update_upload_offset(entry['filename'], entry['offset'])
+
+    def replay_journal(self):
+        """ replay_journal: apply changes recorded since step's snapshot
+            Args: None
+            Returns: None
+        """
+        if not os.path.isfile(self.get_journal_path()):
+            return
+        with open(self.get_journal_path(), 'r') as handle:
+            for line in handle:
+                try:
+                    self.apply_change(json.loads(line))
+                    self.journal_length += 1
+                except ValueError:
+                    # Last line may have been cut off if process was interrupted
+                    config.LOGGER.warning("Skipping incomplete progress journal entry")
 
     def load_progress(self, resume_step):
         """ load_progress: loads progress from restoration file
@@ -95,6 +185,13 @@ class RestoreManager:
             Returns: manager with progress from step
         """
         resume_step = Status[resume_step]
+
+        # Last restoration file points to snapshot of most recent step
+        if resume_step == Status.LAST and self.check_for_session(resume_step):
+            with open(self.get_restore_path(resume_step), 'rb') as handle:
+                last_step = pickle.load(handle)
+            if isinstance(last_step, str):
+                resume_step = Status[last_step]
         progress_path = self.get_restore_path(resume_step)
 
         # If progress is corrupted, revert to step before
@@ -112,6 +209,7 @@ class RestoreManager:
         with open(progress_path, 'rb') as handle:
             manager = pickle.load(handle)
             if isinstance(manager, RestoreManager):
+                manager.replay_journal()
                 return manager
             else:
                 return self
@@ -137,9 +235,9 @@ class RestoreManager:
         """
         # Clear out previous session's restoration files
         for status in Status:
-            path = self.get_restore_path(status)
-            if os.path.isfile(path):
-                os.remove(path)
+            for path in [self.get_restore_path(status), self.get_journal_path(status)]:
+                if os.path.isfile(path):
+                    os.remove(path)
 
         self.record_progress()
         self.status = Status.CONSTRUCT_CHANNEL # Set status to next step
@@ -163,6 +261,24 @@ class RestoreManager:
         self.tree = tree
         self.record_progress()
 
+    def get_file_processed(self, key):
+        """ get_file_processed: retrieves filename of a file processed earlier in this step
+            Args: key (str): position of file in tree
+            Returns: filename of processed file (None if it hasn't been processed)
+        """
+        return self.files_processed.get(key)
+
+    def set_file_processed(self, key, filename):
+        """ set_file_processed: records progress after processing a file
+            Args:
+                key (str): position of file in tree
+                filename (str): name of processed file in storage directory
+            Returns: None
+        """
+        with PROGRESS_LOCK:
+            self.files_processed[key] = filename
+            self.record_change('processed', key=key, filename=filename)
+
     def set_files(self, files_downloaded, files_failed):
         """ set_files: records progress from downloading files
             Args:
@@ -189,9 +305,56 @@ class RestoreManager:
             Args: files_uploaded ([str]): list of files that have been successfully uploaded
             Returns: None
         """
-        self.status = Status.UPLOADING_FILES
-        self.files_uploaded = files_uploaded
-        self.record_progress()
+        with PROGRESS_LOCK:
+            if self.status != Status.UPLOADING_FILES:
+                self.files_uploaded = files_uploaded
+                self.status = Status.UPLOADING_FILES
+                self.record_progress()
+            else:
+                self.record_uploads(files_uploaded)
+
+    def record_uploads(self, files_uploaded):
+        """ record_uploads: records files uploaded since last record without changing step
+            (files are uploaded while they're still being downloaded when stages are pipelined)
+            Args: files_uploaded ([str]): list of files that have been successfully uploaded
+            Returns: None
+        """
+        with PROGRESS_LOCK:
+            new_files = files_uploaded[self.uploads_recorded:]
+            self.files_uploaded = files_uploaded
+            if new_files:
+                self.uploads_recorded = len(files_uploaded)
+                self.record_change('uploaded', files=new_files)
+
+    def get_upload_offset(self, filename):
+        """ get_upload_offset: retrieves how much of a file has been uploaded in chunks
+            Args: filename (str): name of file being uploaded
+            Returns: number of bytes acknowledged by Kolibri Studio
+        """
+        return self.upload_offsets.get(filename, 0)
+
+    def set_upload_offset(self, filename, offset):
+        """ set_upload_offset: records progress after uploading a chunk of a file
+            Args:
+                filename (str): name of file being uploaded
+                offset (int): number of bytes acknowledged by Kolibri Studio (None when file is complete)
+            Returns: None
+        """
+        with PROGRESS_LOCK:
+            self.update_upload_offset(filename, offset)
+            self.record_change('upload_offset', filename=filename, offset=offset)
+
+    def update_upload_offset(self, filename, offset):
+        """ update_upload_offset: sets how much of a file has been uploaded in chunks
+            Args:
+                filename (str): name of file being uploaded
+                offset (int): number of bytes acknowledged by Kolibri Studio (None when file is complete)
+            Returns: None
+        """
+        if offset is None:
+            self.upload_offsets.pop(filename, None)
+        else:
+            self.upload_offsets[filename] = offset
 
     def set_uploaded(self, files_uploaded):
         """ set_uploaded: records progress after uploading files
@@ -3,7 +3,12 @@ import json
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from urllib.parse import urlparse
 from .. import config
+from ..classes.files import FILECACHE, VideoFile
+from ..utils.multipart import MultipartFileEncoder
 from le_utils.constants import file_formats, format_presets
 
 
@@ -18,6 +23,12 @@ class ChannelManager:
         self.uploaded_files=[]
         self.failed_node_builds=[]
         self.failed_uploads=[]
+        self.chunked_uploads = True # Set to False if server doesn't support chunked uploads
+
+    def __setstate__(self, state):
+        # Fill in any attributes missing from sessions saved by older versions
+        self.__init__(state.get('channel'))
+        self.__dict__.update(state)
 
     def validate(self):
         """ validate: checks if tree structure is valid
@@ -26,20 +37,159 @@ class ChannelManager:
         """
         return self.channel.test_tree()
 
-    def process_tree(self, node, parent=None):
+    def process_tree(self, node, parent=None, on_processed=None):
         """ process_tree: processes files
             Args:
                 node (Node): node to process
                 parent (Node): parent of node being processed
+                on_processed (function): called with each node's filenames as it finishes (optional)
+            Returns: list of unique filenames that were processed
+        """
+        # Nodes are processed independently so that node-level steps that depend
+        # on earlier files (e.g. extracted video thumbnails, exercise images)
+        # still run in order, while files from different nodes download in parallel
+        nodes = self.get_nodes(node)
+        if not config.UPDATE:
+            self.resolve_cached_files(nodes)
+
+        # Videos are compressed in the background so workers can carry on downloading meanwhile
+        for f in [f for n in nodes for f in n.files if isinstance(f, VideoFile)]:
+            f.defer_compression = True
+
+        filenames = []
+        order = self.spread_across_hosts(nodes)
+        with ThreadPoolExecutor(max_workers=config.DOWNLOAD_WORKERS) as executor:
+            # Futures are mapped to the files they finish, or to None for nodes being processed
+            pending = {executor.submit(self.process_node, index, nodes[index]): [(index, None)] for index in order}
+            try:
+                while pending:
+                    done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        processed = []
+                        for index, file_index in pending.pop(future):
+                            if file_index is None:
+                                processed += future.result()
+                                for video_index, f in enumerate(nodes[index].files):
+                                    if isinstance(f, VideoFile) and f.compression:
+                                        pending.setdefault(f.compression, []).append((index, video_index))
+                            else:
+                                processed.append(self.finish_compression(index, file_index, nodes[index].files[file_index]))
+                        filenames += processed
+                        if on_processed:
+                            on_processed(processed)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        self.report_compression(nodes)
+        return [x for x in set(filenames) if x] # Remove any duplicate or null files
+
+    def report_compression(self, nodes):
+        """ report_compression: logs how many videos needed compressing and how much space that saves
+            Args: nodes ([Node]): nodes that were processed
             Returns: None
         """
+        plans = [f.compression_plan for n in nodes for f in n.files if isinstance(f, VideoFile) and f.compression_plan]
+        if plans:
+            compressed = len([plan for plan in plans if plan['compress']])
+            saved = sum(plan['size'] - plan['projected_size'] for plan in plans if plan['projected_size'] is not None)
+            config.LOGGER.info("   {0} video(s) compressed, {1} already met compression target ({2:.1f} MB saved)"\
+                .format(compressed, len(plans) - compressed, saved / 1048576))
+
+    def resolve_cached_files(self, nodes):
+        """ resolve_cached_files: looks up all nodes' files in cache at once so cached files don't get processed
+            Args: nodes ([Node]): nodes to look up files for
+            Returns: None
+        """
+        files = [f for node in nodes for f in node.files if not f.filename]
+        keys = {f: f.get_cache_key() for f in files}
+        cached = FILECACHE.get_many([key for key in keys.values() if key])
+
+        # Some files need another lookup once their cached filename is known (e.g. compressed videos)
+        derived_keys = {}
+        for f, key in keys.items():
+            if key in cached:
+                filename = cached[key].decode('utf-8')
+                derived_keys[f] = f.get_derived_cache_key(filename)
+                if not derived_keys[f]:
+                    f.filename = filename
+        cached = FILECACHE.get_many([key for key in derived_keys.values() if key])
+        for f, key in derived_keys.items():
+            if key in cached:
+                f.filename = cached[key].decode('utf-8')
+
+        hits = len([f for f in files if f.filename])
+        config.LOGGER.info("   {0} file(s) found in cache, {1} file(s) to process".format(hits, len(files) - hits))
+
+    def process_node(self, index, node):
+        """ process_node: processes node's files, skipping any processed before session was interrupted
+            Args:
+                index (int): position of node in tree
+                node (Node): node to process
+            Returns: list of filenames that were processed
+        """
+        file_keys = ["{0}/{1}".format(index, file_index) for file_index in range(len(node.files))]
+        for key, f in zip(file_keys, node.files):
+            filename = config.PROGRESS_MANAGER.get_file_processed(key)
+            if filename and os.path.isfile(config.get_storage_path(filename)):
+                f.filename = filename
+
         filenames = node.process_files()
 
-        # Process node's children
-        for child_node in node.children:
-            filenames += self.process_tree(child_node, node)
+        # Only record files node started with, as derived files (e.g. thumbnails) get recreated
+        # (videos being compressed are recorded once they're compressed)
+        for key, f in zip(file_keys, node.files):
+            if f.filename and not getattr(f, 'compression', None) and f.filename != config.PROGRESS_MANAGER.get_file_processed(key):
+                config.PROGRESS_MANAGER.set_file_processed(key, f.filename)
+        return filenames
 
-        return [x for x in set(filenames) if x] # Remove any duplicate or null files
+    def finish_compression(self, index, file_index, f):
+        """ finish_compression: records video once it has been compressed
+            Args:
+                index (int): position of node in tree
+                file_index (int): position of video in node's files
+                f (VideoFile): video that was being compressed
+            Returns: filename of compressed video (None if compression failed)
+        """
+        filename = f.finish_compression()
+        if filename:
+            config.PROGRESS_MANAGER.set_file_processed("{0}/{1}".format(index, file_index), filename)
+        return filename
+
+    def spread_across_hosts(self, nodes):
+        """ spread_across_hosts: orders nodes so that consecutive nodes download from different hosts
+            Workers then don't all wait on one slow (or throttled) host while other hosts sit idle
+            Args: nodes ([Node]): nodes to order
+            Returns: list of indexes of nodes in order they should be processed
+        """
+        counts = {}
+        positions = []
+        for node in nodes:
+            host = self.get_host(node)
+            positions.append(counts.get(host, 0))
+            counts[host] = positions[-1] + 1
+        return sorted(range(len(nodes)), key=lambda index: (positions[index], index))
+
+    def get_host(self, node):
+        """ get_host: finds host node's files are downloaded from
+            Args: node (Node): node to look up
+            Returns: host of first remote file (None if node has none)
+        """
+        for f in node.files:
+            url = getattr(f, 'path', None) or getattr(f, 'web_url', None)
+            if isinstance(url, str) and urlparse(url).netloc:
+                return urlparse(url).netloc
+        return None
+
+    def get_nodes(self, node):
+        """ get_nodes: lists node and all of its descendants
+            Args: node (Node): node to start from
+            Returns: list of nodes in depth-first order
+        """
+        nodes = [node]
+        for child_node in node.children:
+            nodes += self.get_nodes(child_node)
+        return nodes
 
     def check_for_files_failed(self):
         """ check_for_files_failed: print any files that failed during download process
@@ -60,23 +210,76 @@ class ChannelManager:
         else:
             config.LOGGER.info("   All files were successfully downloaded")
 
+    def process_and_upload_tree(self, node):
+        """ process_and_upload_tree: processes files, uploading them to Kolibri Studio as they are processed
+            Args: node (Node): node to process
+            Returns: list of unique filenames that were processed and list of files that weren't on Kolibri Studio
+        """
+        pipeline = UploadPipeline(self)
+        try:
+            filenames = self.process_tree(node, on_processed=pipeline.add)
+            pipeline.finish()
+        finally:
+            pipeline.close()
+        return filenames, pipeline.file_diff
+
     def get_file_diff(self, files_to_diff):
         """ get_file_diff: retrieves list of files that do not exist on content curation server
             Args: None
             Returns: list of files that are not on server
         """
-        file_diff_result = []
-        chunks = [files_to_diff[x:x+1000] for x in range(0, len(files_to_diff), 1000)]
+        file_diff_results = {}
         file_count = 0
         total_count = len(files_to_diff)
-        for chunk in chunks:
-            response = config.SESSION.post(config.file_diff_url(), data=json.dumps(chunk))
-            response.raise_for_status()
-            file_diff_result += json.loads(response._content.decode("utf-8"))
-            file_count += len(chunk)
-            config.LOGGER.info("\tGot file diff for {0} out of {1} files".format(file_count, total_count))
+        position = 0
+        batch_size = config.FILE_DIFF_BATCH_SIZE
+        pending = {}
+        with ThreadPoolExecutor(max_workers=config.FILE_DIFF_WORKERS) as executor:
+            while position < total_count or pending:
+                # Keep up to FILE_DIFF_WORKERS requests in flight
+                while position < total_count and len(pending) < config.FILE_DIFF_WORKERS:
+                    chunk = files_to_diff[position:position + batch_size]
+                    pending[executor.submit(self.get_chunk_diff, chunk)] = (position, chunk)
+                    position += len(chunk)
 
-        return file_diff_result
+                done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, chunk = pending.pop(future)
+                    file_diff_results[start], elapsed = future.result()
+                    batch_size = self.get_diff_batch_size(batch_size, chunk, elapsed)
+                    file_count += len(chunk)
+                    config.LOGGER.info("\tGot file diff for {0} out of {1} files".format(file_count, total_count))
+
+        # Merge results in the same order as files_to_diff
+        return [f for start in sorted(file_diff_results) for f in file_diff_results[start]]
+
+    def get_chunk_diff(self, chunk):
+        """ get_chunk_diff: retrieves which files in a chunk do not exist on content curation server
+            Args:
+                chunk ([str]): list of files to check
+            Returns: list of files that are not on server and number of seconds request took
+        """
+        start_time = time.time()
+        response = config.SESSION.post(config.file_diff_url(), data=json.dumps(chunk))
+        response.raise_for_status()
+        return json.loads(response._content.decode("utf-8")), time.time() - start_time
+
+    def get_diff_batch_size(self, batch_size, chunk, elapsed):
+        """ get_diff_batch_size: adjusts batch size based on how long the last file diff request took
+            Args:
+                batch_size (int): current batch size
+                chunk ([str]): files sent in last request
+                elapsed (float): seconds the last request took
+            Returns: batch size to use for next request
+        """
+        # Move halfway towards the size that would have hit the target latency
+        if elapsed > 0:
+            batch_size = (batch_size + int(len(chunk) * config.FILE_DIFF_TARGET_LATENCY / elapsed)) // 2
+
+        # Keep payload under size limit
+        item_size = len(json.dumps(chunk)) / max(len(chunk), 1)
+        max_batch_size = max(int(config.FILE_DIFF_MAX_PAYLOAD / item_size), config.FILE_DIFF_MIN_BATCH_SIZE)
+        return min(max(batch_size, config.FILE_DIFF_MIN_BATCH_SIZE), max_batch_size)
 
     def upload_files(self, file_list):
         """ upload_files: uploads files to server
@@ -86,20 +289,86 @@ class ChannelManager:
         """
         counter = 0
         files_to_upload = list(set(file_list) - set(self.uploaded_files)) # In case restoring from previous session
+        executor = ThreadPoolExecutor(max_workers=config.UPLOAD_WORKERS)
+        futures = {executor.submit(self.upload_file, f): f for f in files_to_upload}
         try:
-            for f in files_to_upload:
-                with  open(config.get_storage_path(f), 'rb') as file_obj:
-                    response = config.SESSION.post(config.file_upload_url(), files={'file': file_obj})
-                    if response.status_code == 200:
-                        response.raise_for_status()
-                        self.uploaded_files.append(f)
-                        counter += 1
-                        config.LOGGER.info("\tUploaded {0} ({count}/{total}) ".format(f, count=counter, total=len(files_to_upload)))
-                    else:
-                        self.failed_uploads.append(f)
+            # Results are only recorded on this thread, so the lists don't need locking
+            for future in as_completed(futures):
+                f = futures[future]
+                if future.result().status_code == 200:
+                    self.uploaded_files.append(f)
+                    counter += 1
+                    config.LOGGER.info("\tUploaded {0} ({count}/{total}) ".format(f, count=counter, total=len(files_to_upload)))
+                    if counter % config.UPLOAD_CHECKPOINT_INTERVAL == 0:
+                        config.PROGRESS_MANAGER.set_uploading(self.uploaded_files)
+                else:
+                    self.failed_uploads.append(f)
         finally:
+            # Don't start any more uploads if one of them raised an error
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
             config.PROGRESS_MANAGER.set_uploading(self.uploaded_files)
 
+    def upload_file(self, filename):
+        """ upload_file: uploads a single file to server
+            Args:
+                filename (str): name of file in storage directory
+            Returns: response from file_upload endpoint
+        """
+        if config.CHUNKED_UPLOAD_THRESHOLD is not None and self.chunked_uploads and \
+                os.path.getsize(config.get_storage_path(filename)) > config.CHUNKED_UPLOAD_THRESHOLD:
+            response = self.upload_file_in_chunks(filename)
+            if response is not None:
+                return response
+            config.LOGGER.warning("\tServer doesn't support chunked uploads, uploading whole files instead")
+            self.chunked_uploads = False
+
+        with open(config.get_storage_path(filename), 'rb') as file_obj:
+            # Stream file from disk rather than building the whole request body in memory
+            body = MultipartFileEncoder('file', file_obj)
+            return config.SESSION.post(config.file_upload_url(), data=body, headers={'Content-Type': body.content_type})
+
+    def upload_file_in_chunks(self, filename):
+        """ upload_file_in_chunks: uploads a large file to server in resumable chunks
+            Each chunk is sent with a Content-Range header and Kolibri Studio replies with
+            the offset it has received so far, which is saved so that a failed upload can
+            resume from there. If Kolibri Studio is expecting a different offset (e.g. it
+            discarded earlier chunks), it replies with 416 and the offset to continue from.
+            Args:
+                filename (str): name of file in storage directory
+            Returns: response from last file_upload_chunk request (None if server doesn't support chunked uploads)
+        """
+        path = config.get_storage_path(filename)
+        total = os.path.getsize(path)
+        offset = min(config.PROGRESS_MANAGER.get_upload_offset(filename), total - 1)
+        with open(path, 'rb') as file_obj:
+            while True:
+                file_obj.seek(offset)
+                chunk = file_obj.read(config.UPLOAD_CHUNK_SIZE)
+                headers = {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Range': 'bytes {0}-{1}/{2}'.format(offset, offset + len(chunk) - 1, total),
+                }
+                response = config.SESSION.post(config.file_upload_chunk_url(), params={'filename': filename}, data=chunk, headers=headers)
+                if response.status_code in (404, 405):
+                    return None
+                if response.status_code not in (200, 416):
+                    return response
+
+                try:
+                    expected_offset = int(json.loads(response._content.decode("utf-8"))['offset'])
+                except (ValueError, KeyError, TypeError):
+                    return None # Response isn't from a chunked upload endpoint
+                if response.status_code == 416 and expected_offset == offset:
+                    return response
+                if expected_offset >= total:
+                    config.PROGRESS_MANAGER.set_upload_offset(filename, None)
+                    return response
+
+                offset = expected_offset
+                config.PROGRESS_MANAGER.set_upload_offset(filename, offset)
+
     def reattempt_upload_fails(self):
         """ reattempt_upload_fails: uploads failed files to server
             Args: None
@@ -131,10 +400,9 @@ class ChannelManager:
                 # Attempt to upload file
                 try:
                     assert f.filename, "File failed to download (cannot be uploaded)"
-                    with open(config.get_storage_path(f.filename), 'rb') as file_obj:
-                        response = config.SESSION.post(config.file_upload_url(), files={'file': file_obj})
-                        response.raise_for_status()
-                        self.uploaded_files.append(f.filename)
+                    response = self.upload_file(f.filename)
+                    response.raise_for_status()
+                    self.uploaded_files.append(f.filename)
                 except AssertionError as ae:
                     config.LOGGER.warning(ae)
             # Attempt to create node
@@ -170,29 +438,47 @@ class ChannelManager:
 
     def add_nodes(self, root_id, current_node, indent=1):
         """ add_nodes: adds processed nodes to tree
+            Nodes are created in level order, and each node's children are sent as soon
+            as the node has been created, so sibling subtrees are created concurrently
             Args:
                 root_id (str): id of parent node on Kolibri Studio
                 current_node (Node): node to publish children
                 indent (int): level of indentation for printing
             Returns: link to uploadedchannel
         """
-        # if the current node has no children, no need to continue
-        if not current_node.children:
-            return
+        pending = {}
+        parents = [(root_id, current_node, indent)]
+        with ThreadPoolExecutor(max_workers=config.ADD_NODES_WORKERS) as executor:
+            while parents or pending:
+                # if a node has no children, no need to continue
+                for root_id, node, indent in parents:
+                    if node.children:
+                        config.LOGGER.info("{indent}Processing {title} ({kind})".format(indent="   " * indent, title=node.title, kind=node.__class__.__name__))
+                        pending[executor.submit(self.add_children, root_id, node)] = (root_id, node, indent)
+                parents = []
 
-        config.LOGGER.info("{indent}Processing {title} ({kind})".format(indent="   " * indent, title=current_node.title, kind=current_node.__class__.__name__))
+                done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root_id, node, indent = pending.pop(future)
+                    response = future.result()
+                    if response.status_code != 200:
+                        self.failed_node_builds += [(root_id, node, response.reason)]
+                    else:
+                        response_json = json.loads(response._content.decode("utf-8"))
+                        parents += [(response_json['root_ids'][child.get_node_id().hex], child, indent + 1) for child in node.children]
+
+    def add_children(self, root_id, node):
+        """ add_children: sends node's children to server
+            Args:
+                root_id (str): id of node on Kolibri Studio
+                node (Node): node to publish children
+            Returns: response from add_nodes endpoint
+        """
         payload = {
             'root_id': root_id,
-            'content_data': [child.to_dict() for child in current_node.children]
+            'content_data': [child.to_dict() for child in node.children]
         }
-        response = config.SESSION.post(config.add_nodes_url(), data=json.dumps(payload))
-        if response.status_code != 200:
-            self.failed_node_builds += [(root_id, current_node, response.reason)]
-        else:
-            response_json = json.loads(response._content.decode("utf-8"))
-
-            for child in current_node.children:
-                self.add_nodes(response_json['root_ids'][child.get_node_id().hex], child, indent + 1)
+        return config.SESSION.post(config.add_nodes_url(), data=json.dumps(payload))
 
     def commit_channel(self, channel_id):
         """ commit_channel: commits channel to Kolibri Studio
@@ -220,3 +506,99 @@ class ChannelManager:
         }
         response = config.SESSION.post(config.publish_channel_url(), data=json.dumps(payload))
         response.raise_for_status()
+
+
+class UploadPipeline:
+    """ Checks files against Kolibri Studio and uploads them while other files are still being processed
+
+        Files are sent to the file diff endpoint in batches as they are added, and any
+        that Kolibri Studio doesn't have are uploaded right away. Results are only
+        collected on the thread adding files, so the manager's lists don't need locking.
+
+        Attributes:
+            manager (ChannelManager): manager to upload files with
+            file_diff ([str]): list of files that weren't on Kolibri Studio
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.file_diff = []
+        self.seen = set(manager.uploaded_files) # Files uploaded before session was interrupted
+        self.batch = []
+        self.batch_started = None
+        self.diffs = set()
+        self.uploads = {}
+        self.upload_count = 0
+        self.diff_executor = ThreadPoolExecutor(max_workers=config.FILE_DIFF_WORKERS)
+        self.upload_executor = ThreadPoolExecutor(max_workers=config.UPLOAD_WORKERS)
+
+    def add(self, filenames):
+        """ add: queues processed files to be checked and uploaded
+            Args: filenames ([str]): names of files in storage directory
+            Returns: None
+        """
+        for filename in filenames:
+            if filename and filename not in self.seen:
+                self.seen.add(filename)
+                self.batch.append(filename)
+                self.batch_started = self.batch_started or time.time()
+        if len(self.batch) >= config.FILE_DIFF_MIN_BATCH_SIZE or \
+                (self.batch and time.time() - self.batch_started >= config.PIPELINE_DIFF_INTERVAL):
+            self.send_batch()
+        self.collect()
+
+    def send_batch(self):
+        """ send_batch: sends queued files to file diff endpoint
+            Args: None
+            Returns: None
+        """
+        if self.batch:
+            self.diffs.add(self.diff_executor.submit(self.manager.get_chunk_diff, self.batch))
+            self.batch = []
+            self.batch_started = None
+
+    def collect(self, block=False):
+        """ collect: handles finished file diffs and uploads
+            Args: block (bool): wait until all file diffs and uploads have finished (optional)
+            Returns: None
+        """
+        while self.diffs or self.uploads:
+            done, _not_done = wait(list(self.diffs) + list(self.uploads), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            if not done:
+                return
+            for future in done:
+                if future in self.diffs:
+                    self.diffs.remove(future)
+                    missing, _elapsed = future.result()
+                    self.file_diff += missing
+                    for f in missing:
+                        self.uploads[self.upload_executor.submit(self.manager.upload_file, f)] = f
+                    continue
+
+                f = self.uploads.pop(future)
+                if future.result().status_code == 200:
+                    self.manager.uploaded_files.append(f)
+                    self.upload_count += 1
+                    config.LOGGER.info("\tUploaded {0} ({count}/{total}) ".format(f, count=self.upload_count, total=len(self.file_diff)))
+                    if self.upload_count % config.UPLOAD_CHECKPOINT_INTERVAL == 0:
+                        config.PROGRESS_MANAGER.record_uploads(self.manager.uploaded_files)
+                else:
+                    self.manager.failed_uploads.append(f)
+
+    def finish(self):
+        """ finish: checks and uploads any remaining files
+            Args: None
+            Returns: None
+        """
+        self.send_batch()
+        self.collect(block=True)
+
+    def close(self):
+        """ close: stops pipeline, recording files uploaded so far
+            Args: None
+            Returns: None
+        """
+        for future in list(self.diffs) + list(self.uploads):
+            future.cancel()
+        self.diff_executor.shutdown(wait=True)
+        self.upload_executor.shutdown(wait=True)
+        config.PROGRESS_MANAGER.record_uploads(self.manager.uploaded_files)
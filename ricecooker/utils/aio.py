@@ -0,0 +1,71 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .. import config
+from ..classes import files
+
+# Coroutines for chefs that fetch files with asyncio (needs Python 3.5+ for async/await,
+# so nothing else in ricecooker imports this module)
+# Requests below go through config.DOWNLOAD_SESSION, which is only throttled per host once
+# commands.uploadchannel has mounted its ThrottledHTTPAdapter (chefs that use these
+# coroutines outside of uploadchannel need to mount one themselves)
+
+# Thread pool that coroutines below run blocking network operations on
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor():
+    """ get_executor: gets thread pool shared by coroutines (created on first use)
+        Args: None
+        Returns: ThreadPoolExecutor
+    """
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=config.ASYNC_IO_WORKERS)
+        return EXECUTOR
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ run_blocking: runs blocking function without blocking event loop
+        Args:
+            func (function): function to run
+            args, kwargs: arguments to call function with
+        Returns: function's return value
+    """
+    loop = asyncio.get_event_loop() # Loop running this coroutine
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def download(path, default_ext=None):
+    """ download: downloads file into storage (see ricecooker.classes.files.download)
+        Args:
+            path (str): url or local path of file
+            default_ext (str): extension to use if path doesn't have one (optional)
+        Returns: filename
+    """
+    return await run_blocking(files.download, path, default_ext=default_ext)
+
+
+async def download_many(paths, default_ext=None):
+    """ download_many: downloads several files into storage at once
+        Args:
+            paths ([str]): urls or local paths of files
+            default_ext (str): extension to use if a path doesn't have one (optional)
+        Returns: list of filenames in same order as paths
+    """
+    return await asyncio.gather(*[download(path, default_ext=default_ext) for path in paths])
+
+
+async def get(url, **kwargs):
+    """ get: sends GET request through config.DOWNLOAD_SESSION (so it's throttled like downloads
+            once uploadchannel has mounted its ThrottledHTTPAdapter)
+        Args:
+            url (str): url to request
+            kwargs: arguments to pass to requests (e.g. headers)
+        Returns: Response with its content already read
+    """
+    kwargs['stream'] = False
+    return await run_blocking(config.DOWNLOAD_SESSION.get, url, **kwargs)
@@ -1,4 +1,7 @@
+import os
 import requests
+import sqlite3
+import threading
 import cachecontrol
 
 from datetime import datetime, timedelta
@@ -53,3 +56,66 @@ class InvalidatingCacheControlAdapter(CacheControlAdapter):
         resp = super(InvalidatingCacheControlAdapter, self).send(request, **kw)
 
         return resp
+
+
+class SQLiteCache(object):
+    """
+    Key-value cache stored in an indexed SQLite database, safe to use from many threads.
+    Values are bytes (same as FileCache). Keys missing from the database are looked up
+    in the legacy FileCache directory (if provided) and copied over when found.
+    """
+    BATCH_SIZE = 500  # Stay under SQLite's limit on query parameters
+
+    def __init__(self, path, legacy_directory=None):
+        self.path = path
+        self.legacy_cache = FileCache(legacy_directory, forever=True) if legacy_directory else None
+        self.local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread opens its own
+        path = os.path.abspath(self.path)
+        connections = self.local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            connection = sqlite3.connect(path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            connections[path] = connection
+        return connections[path]
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """ Returns dict of cached values for keys that are in the cache """
+        keys = list(set(keys))
+        values = {}
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i + self.BATCH_SIZE]
+            query = "SELECT key, value FROM cache WHERE key IN ({})".format(",".join("?" * len(batch)))
+            values.update((key, bytes(value)) for key, value in self._connection().execute(query, batch))
+
+        # Migrate any keys that are only in the legacy cache
+        if self.legacy_cache and os.path.isdir(self.legacy_cache.directory):
+            migrated = {}
+            for key in keys:
+                if key not in values:
+                    value = self.legacy_cache.get(key)
+                    if value:
+                        migrated[key] = value
+            self.set_many(migrated)
+            values.update(migrated)
+        return values
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """ Stores dict of keys mapped to values """
+        if items:
+            with self._connection() as connection:
+                connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", items.items())
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
@@ -0,0 +1,21 @@
+import hashlib
+import mmap
+
+
+def hash_file(path):
+    """ hash_file: hashes file's contents
+        Args: path (str): path to file
+        Returns: MD5 hash of file
+    """
+    content_hash = hashlib.md5()
+    with open(path, 'rb') as fobj:
+        try:
+            # Hash memory-mapped file to avoid copying it into python in chunks
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                content_hash.update(mapped)
+        except (ValueError, OSError):
+            # Empty files and some special files can't be memory-mapped
+            for chunk in iter(lambda: fobj.read(2097152), b""):
+                content_hash.update(chunk)
+    return content_hash
+
@@ -0,0 +1,50 @@
+import io
+import os
+import uuid
+
+
+class MultipartFileEncoder(object):
+    """ File-like multipart/form-data body for uploading a single file
+
+        The body is produced as it is read, so the file is streamed from disk
+        in whatever chunk size the connection asks for instead of being built
+        up in memory first.
+
+        Attributes:
+            field (str): name of form field to send file as
+            file_obj (file): open binary file to upload
+            filename (str): filename to send with file (optional)
+    """
+    def __init__(self, field, file_obj, filename=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self.filename = filename or os.path.basename(file_obj.name)
+
+        header = "--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n\r\n"\
+                .format(boundary=self.boundary, field=field, filename=self.filename).encode('utf-8')
+        footer = "\r\n--{boundary}--\r\n".format(boundary=self.boundary).encode('utf-8')
+
+        file_obj.seek(0, os.SEEK_END)
+        self.length = len(header) + file_obj.tell() + len(footer)
+        file_obj.seek(0)
+
+        self.parts = [io.BytesIO(header), file_obj, io.BytesIO(footer)]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """ read: reads next chunk of body
+            Args: size (int): maximum number of bytes to read (reads everything if negative)
+            Returns: bytes of body
+        """
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
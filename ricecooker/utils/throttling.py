@@ -0,0 +1,156 @@
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from .. import config
+
+
+class Throttle(object):
+    """ Limits how many requests are sent to each host at once and how often
+
+        Hosts that ask clients to back off (e.g. with a 429 response) are paused
+        for every worker, not just the one that got the response.
+
+        Attributes:
+            concurrency (int): maximum number of requests to a host at once
+            delay (float): minimum number of seconds between starting requests to a host
+    """
+    def __init__(self, concurrency=4, delay=0):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.next_times = {}
+
+    def acquire(self, host):
+        """ acquire: waits until a request can be sent to host
+            Args: host (str): host to send request to
+            Returns: None
+        """
+        with self.lock:
+            slot = self.slots.setdefault(host, threading.BoundedSemaphore(self.concurrency))
+        slot.acquire()
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    wait = self.next_times.get(host, now) - now
+                    if wait <= 0:
+                        self.next_times[host] = now + self.delay
+                        return
+                time.sleep(wait) # Check again afterwards, as host may have been paused in the meantime
+        except BaseException:
+            slot.release()
+            raise
+
+    def release(self, host):
+        """ release: marks request to host as finished
+            Args: host (str): host request was sent to
+            Returns: None
+        """
+        self.slots[host].release()
+
+    def backoff(self, host, seconds):
+        """ backoff: pauses requests to host
+            Args:
+                host (str): host to pause
+                seconds (float): number of seconds to pause for
+            Returns: None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.next_times[host] = max(self.next_times.get(host, now), now + seconds)
+
+
+class ThrottledHTTPAdapter(HTTPAdapter):
+    """ HTTP adapter that sends requests through a Throttle, one per host
+
+        A host's slot is held until the response's body has been read (or the
+        response is closed), so streamed downloads count towards the host's limit.
+        Responses with a status in RETRY_STATUSES are retried after waiting for
+        their Retry-After header (or an exponential backoff if there isn't one).
+
+        Attributes:
+            throttle (Throttle): throttle to send requests through
+            attempts (int): number of times to send requests that are asked to be retried
+    """
+    RETRY_STATUSES = (429, 503)
+
+    def __init__(self, throttle=None, attempts=3, **kwargs):
+        self.throttle = throttle or Throttle()
+        self.attempts = attempts
+        kwargs.setdefault('pool_maxsize', self.throttle.concurrency)
+        super(ThrottledHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        attempt = 1
+        while True:
+            self.throttle.acquire(host)
+            try:
+                response = super(ThrottledHTTPAdapter, self).send(request, **kwargs)
+            except BaseException:
+                self.throttle.release(host)
+                raise
+            release = self.hold_slot(host, response)
+
+            if response.status_code not in self.RETRY_STATUSES or attempt >= self.attempts:
+                return response
+
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = config.DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+            delay = min(delay, config.DOWNLOAD_MAX_BACKOFF)
+            config.LOGGER.warning("\t--- {} responded {}, waiting {:.1f}s".format(host, response.status_code, delay))
+            self.throttle.backoff(host, delay)
+            response.close()
+            release()
+            attempt += 1
+
+    def hold_slot(self, host, response):
+        """ hold_slot: keeps host's slot until response's connection is released
+            Args:
+                host (str): host response is from
+                response (Response): response to hold slot for
+            Returns: function that releases slot (only the first call has any effect)
+        """
+        lock = threading.Lock()
+        released = []
+        def release():
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            self.throttle.release(host)
+
+        release_conn = response.raw.release_conn
+        def release_conn_and_slot():
+            release_conn()
+            release()
+        response.raw.release_conn = release_conn_and_slot
+        weakref.finalize(response, release) # In case response is discarded without being read or closed
+        return release
+
+
+def get_retry_after(response):
+    """ get_retry_after: reads number of seconds to wait from response's Retry-After header
+        Args: response (Response): response to read header from
+        Returns: number of seconds (None if header is missing or invalid)
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,24 @@
+import pytest
+import threading
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+""" *********** HTTP SERVER FIXTURES *********** """
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture
+def http_server():
+    """ Starts local servers for a test (call with handler class), shutting them down afterwards """
+    servers = []
+    def start(handler, threaded=False):
+        server = (ThreadedHTTPServer if threaded else HTTPServer)(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,317 @@
+import asyncio
+import hashlib
+import os
+import pytest
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from le_utils.constants import format_presets, licenses
+from ricecooker import config
+from ricecooker.classes import files
+from ricecooker.classes.nodes import VideoNode
+from ricecooker.classes.files import download, get_hash
+from ricecooker.utils.hashing import hash_file
+
+
+""" *********** FILE FIXTURES *********** """
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    return tmpdir
+
+@pytest.fixture
+def local_path(workdir):
+    path = workdir.join("source.pdf")
+    path.write_binary(b"0123456789" * 100000)
+    return str(path)
+
+class ContentHandler(BaseHTTPRequestHandler):
+    """ Serves server.content with an ETag, honouring If-None-Match and Range (with If-Range)
+        Connection is dropped after server.drop_after bytes of a response (if set), once
+    """
+    def do_GET(self):
+        content = self.server.content
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        self.server.ranges.append(self.headers.get('Range'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len("bytes="):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if self.server.drop_after:
+            self.wfile.write(content[start:start + self.server.drop_after])
+            self.server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def content_server(http_server):
+    server = http_server(ContentHandler)
+    server.content, server.requests, server.ranges, server.drop_after = b"version 1", [], [], None
+    return server
+
+
+""" *********** LOCAL FILE TESTS *********** """
+def test_download_local_file(local_path):
+    filename = download(local_path)
+    storage_path = config.get_storage_path(filename)
+    assert filename == "{}.pdf".format(get_hash(local_path))
+    assert open(storage_path, 'rb').read() == open(local_path, 'rb').read()
+    assert os.stat(storage_path).st_ino != os.stat(local_path).st_ino
+
+def test_download_local_file_hardlink(local_path, monkeypatch):
+    monkeypatch.setattr(config, 'HARDLINK_LOCAL_FILES', True)
+    filename = download(local_path)
+    assert os.stat(config.get_storage_path(filename)).st_ino == os.stat(local_path).st_ino
+
+def test_download_empty_local_file(workdir):
+    workdir.join("empty.pdf").write_binary(b"")
+    with pytest.raises(AssertionError):
+        download(str(workdir.join("empty.pdf")))
+
+def test_local_file_hash_is_cached(local_path, monkeypatch):
+    monkeypatch.setattr(config, 'UPDATE', True)
+    hashed = []
+    monkeypatch.setattr(files, 'hash_file', lambda path: hashed.append(path) or hash_file(path))
+
+    filename = download(local_path)
+    assert download(local_path) == filename
+    assert len(hashed) == 1
+
+    # Changing file invalidates cached checksum
+    with open(local_path, 'ab') as fobj:
+        fobj.write(b"more")
+    assert download(local_path) != filename
+    assert len(hashed) == 2
+
+
+""" *********** REMOTE FILE TESTS *********** """
+def test_download_revalidates_on_update(workdir, content_server, monkeypatch):
+    url = "http://127.0.0.1:{}/document.pdf".format(content_server.server_port)
+    filename = download(url)
+    assert open(config.get_storage_path(filename), 'rb').read() == b"version 1"
+
+    monkeypatch.setattr(config, 'UPDATE', True)
+    assert download(url) == filename
+    assert content_server.requests[-1] is not None  # Sent If-None-Match and got 304
+
+    content_server.content = b"version 2"
+    new_filename = download(url)
+    assert new_filename != filename
+    assert open(config.get_storage_path(new_filename), 'rb').read() == b"version 2"
+    assert not [f for f in os.listdir(config.STORAGE_DIRECTORY) if os.path.isfile(os.path.join(config.STORAGE_DIRECTORY, f))]
+
+def test_download_resumes_interrupted_download(workdir, content_server):
+    content_server.content = os.urandom(100000)
+    content_server.drop_after = 70000
+    url = "http://127.0.0.1:{}/video.mp4".format(content_server.server_port)
+
+    filename = download(url)
+    assert filename == "{}.mp4".format(hashlib.md5(content_server.content).hexdigest())
+    assert open(config.get_storage_path(filename), 'rb').read() == content_server.content
+    assert content_server.ranges == [None, "bytes={}-".format(files.DOWNLOAD_CHUNK_SIZE)]
+    assert not [f for f in os.listdir(config.STORAGE_DIRECTORY) if f.endswith(".part")]
+
+def test_download_restarts_changed_partial_download(workdir, content_server, monkeypatch):
+    monkeypatch.setattr(config, 'DOWNLOAD_ATTEMPTS', 1)
+    content_server.content = os.urandom(100000)
+    content_server.drop_after = 70000
+    url = "http://127.0.0.1:{}/video.mp4".format(content_server.server_port)
+    with pytest.raises(IOError):
+        download(url)
+
+    # Partial download is kept between runs, but not used once file has changed on server
+    content_server.content = os.urandom(100000)
+    filename = download(url)
+    assert open(config.get_storage_path(filename), 'rb').read() == content_server.content
+    assert content_server.ranges == [None, "bytes={}-".format(files.DOWNLOAD_CHUNK_SIZE)]
+
+def test_download_locks_are_dropped():
+    with files.get_download_lock("http://a.com/a.pdf"):
+        with files.get_download_lock("http://b.com/b.pdf"):  # Other urls aren't held up
+            assert sorted(files.DOWNLOAD_LOCKS) == ["http://a.com/a.pdf", "http://b.com/b.pdf"]
+    assert files.DOWNLOAD_LOCKS == {}
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="async/await needs Python 3.5+")
+def test_download_many_async(workdir, content_server, local_path):
+    from ricecooker.utils import aio
+    url = "http://127.0.0.1:{}/document.pdf".format(content_server.server_port)
+    loop = asyncio.new_event_loop()
+    try:
+        filenames = loop.run_until_complete(aio.download_many([url, local_path]))
+    finally:
+        loop.close()
+    assert filenames == [download(url), download(local_path)]
+    assert open(config.get_storage_path(filenames[0]), 'rb').read() == b"version 1"
+
+
+""" *********** WEB VIDEO TESTS *********** """
+class MockYoutubeDL(object):
+    """ Writes url to outtmpl instead of downloading it """
+    instances = []
+    downloads = []
+
+    def __init__(self, params):
+        self.params = params
+        MockYoutubeDL.instances.append(self)
+
+    def download(self, urls):
+        MockYoutubeDL.downloads.append(urls[0])
+        if self.params.get('writesubtitles'):
+            for lang in self.params['subtitleslangs']:
+                with open("{}.{}.vtt".format(self.params['outtmpl'], lang), 'wb') as fobj:
+                    fobj.write("WEBVTT {} {}".format(urls[0], lang).encode('utf-8'))
+            return
+        with open(self.params['outtmpl'], 'wb') as fobj:
+            fobj.write(urls[0].encode('utf-8'))
+
+def test_download_from_web_reuses_youtube_dl(workdir, monkeypatch):
+    monkeypatch.setattr(files.youtube_dl, 'YoutubeDL', MockYoutubeDL)
+    monkeypatch.setattr(MockYoutubeDL, 'instances', [])
+    monkeypatch.setattr(MockYoutubeDL, 'downloads', [])
+    urls = ["http://www.youtube.com/watch?v={}".format(i) for i in range(8)]
+    settings = {'format': 'best'}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        filenames = list(executor.map(lambda url: files.download_from_web(url, settings), urls))
+    assert [open(config.get_storage_path(f), 'rb').read().decode('utf-8') for f in filenames] == urls
+    assert len(MockYoutubeDL.instances) <= 2
+    assert settings == {'format': 'best'}
+
+def test_download_from_web_shares_video(workdir, monkeypatch):
+    monkeypatch.setattr(files.youtube_dl, 'YoutubeDL', MockYoutubeDL)
+    monkeypatch.setattr(MockYoutubeDL, 'downloads', [])
+    url = "http://www.youtube.com/watch?v=abc123"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        filenames = list(executor.map(lambda i: files.download_from_web(url, {}), range(4)))
+    assert len(set(filenames)) == 1
+    assert open(config.get_storage_path(filenames[0]), 'rb').read().decode('utf-8') == url
+    assert MockYoutubeDL.downloads == [url]
+
+def test_youtube_subtitles_are_extracted_once(workdir, monkeypatch):
+    monkeypatch.setattr(files.youtube_dl, 'YoutubeDL', MockYoutubeDL)
+    monkeypatch.setattr(MockYoutubeDL, 'downloads', [])
+    languages = ['en', 'es', 'fr']
+    node = VideoNode(source_id="video", title="Video", license=licenses.PUBLIC_DOMAIN,
+                     files=[files.YouTubeSubtitleFile("abc123", language=lang) for lang in languages])
+
+    filenames = node.process_files()
+    assert len(MockYoutubeDL.downloads) == 1
+    assert [open(config.get_storage_path(f), 'rb').read().decode('utf-8').split()[-1] for f in filenames] == languages
+
+def test_youtube_subtitles_are_shared(workdir, monkeypatch):
+    monkeypatch.setattr(files.youtube_dl, 'YoutubeDL', MockYoutubeDL)
+    monkeypatch.setattr(MockYoutubeDL, 'downloads', [])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda i: files.download_youtube_subtitles("abc123", ['en', 'es']), range(4)))
+    assert len(MockYoutubeDL.downloads) == 1
+    assert all(result == results[0] for result in results)
+    assert [open(config.get_storage_path(results[0][lang]), 'rb').read().decode('utf-8').split()[-1] for lang in ['en', 'es']] == ['en', 'es']
+
+
+""" *********** VIDEO PROBE TESTS *********** """
+@pytest.fixture
+def probes(workdir, monkeypatch):
+    probes = []
+    def check_output(command):
+        probes.append(command)
+        return b'{"streams": [{"codec_type": "audio", "codec_name": "aac"}, {"codec_type": "video", "codec_name": "h264", "width": 1280, "height": 720}],' \
+               b' "format": {"duration": "12.5", "bit_rate": "800000"}}'
+    monkeypatch.setattr(files.subprocess, 'check_output', check_output)
+    workdir.join("video.mp4").write_binary(b"video")
+    return probes
+
+def test_video_probe_is_cached(workdir, probes):
+
+    video = files.VideoFile(str(workdir.join("video.mp4")))
+    video.process_file()
+    assert files.probe_video(video.filename) == {'width': 1280, 'height': 720, 'duration': 12.5, 'codec': 'h264', 'bitrate': 800000}
+    assert video.get_preset() == format_presets.VIDEO_HIGH_RES
+
+    # Same video is never probed again
+    video = files.VideoFile(str(workdir.join("video.mp4")))
+    video.process_file()
+    video.get_preset()
+    assert len(probes) == 1
+
+def test_failed_video_probe_is_not_cached(workdir, monkeypatch):
+    def check_output(command):
+        raise files.CalledProcessError(1, command)
+    monkeypatch.setattr(files.subprocess, 'check_output', check_output)
+    workdir.join("video.mp4").write_binary(b"video")
+    filename = files.download(str(workdir.join("video.mp4")))
+
+    assert files.probe_video(filename) is None
+    assert files.FILECACHE.get("PROBE: {}".format(filename)) is None
+
+def test_extract_thumbnail_seeks_to_middle(workdir, probes, monkeypatch):
+    commands = []
+    def call(command):
+        commands.append(command)
+        with open(command[-1], 'wb') as fobj:
+            fobj.write(b"thumbnail")
+    monkeypatch.setattr(files.subprocess, 'call', call)
+
+    video = files.VideoFile(str(workdir.join("video.mp4")))
+    video.process_file()
+    thumbnail = files.ExtractedVideoThumbnailFile(config.get_storage_path(video.filename))
+    assert open(config.get_storage_path(thumbnail.process_file()), 'rb').read() == b"thumbnail"
+    assert commands[0].index('-ss') < commands[0].index('-i')
+    assert commands[0][commands[0].index('-ss') + 1] == "6.25"
+    assert len(probes) == 1
+
+def test_compression_skips_videos_meeting_target(workdir, monkeypatch):
+    monkeypatch.setattr(files.subprocess, 'check_output', lambda command: b'{"streams": [{"codec_type": "video",' \
+        b' "codec_name": "h264", "width": 640, "height": 360}], "format": {"duration": "60.0", "bit_rate": "400000"}}')
+    monkeypatch.setattr(files, 'compress_video', lambda *args, **kwargs: pytest.fail("Video shouldn't be compressed"))
+    monkeypatch.setattr(config, 'COMPRESS', True)
+    workdir.join("small.mp4").write_binary(b"small video")
+
+    video = files.VideoFile(str(workdir.join("small.mp4")))
+    filename = video.process_file()
+    assert open(config.get_storage_path(filename), 'rb').read() == b"small video"
+    assert video.compression is None and not video.compression_plan['compress']
+
+    # Decision is cached for these targets (too big for max_width setting or a lower target though)
+    monkeypatch.setattr(files.subprocess, 'check_output', lambda command: pytest.fail("Video shouldn't be probed again"))
+    assert not files.plan_compression(filename, None)['compress']
+    assert files.plan_compression(filename, {'max_width': 320})['compress']
+    monkeypatch.setattr(config, 'COMPRESSION_MAX_HEIGHT', 240)
+    assert files.plan_compression(filename, None)['compress']
+
+def test_compression_plan_projects_size(workdir, probes):
+    workdir.join("large.mp4").write_binary(b"0" * 2000000)
+    filename = files.download(str(workdir.join("large.mp4")))
+    assert files.plan_compression(filename, None) == {'compress': True, 'size': 2000000, 'projected_size': 937500}
+
+def test_compression_of_missing_video_fails(workdir, monkeypatch):
+    monkeypatch.setattr(config, 'COMPRESS', True)
+    monkeypatch.setattr(config, 'FAILED_FILES', [])
+    workdir.join("video.mp4").write_binary(b"video")
+    video = files.VideoFile(str(workdir.join("video.mp4")))
+    filename = files.download(video.path)
+    os.remove(config.get_storage_path(filename))  # Cached download whose file is gone
+
+    assert video.process_file() is None
+    assert config.FAILED_FILES == [video]
+
+def test_available_memory_reads_meminfo(tmpdir):
+    meminfo = tmpdir.join("meminfo")
+    meminfo.write("MemTotal:       16000000 kB\nMemFree:          500000 kB\nMemAvailable:    8000000 kB\n")
+    assert files.get_available_memory(str(meminfo)) == 8000000 * 1024
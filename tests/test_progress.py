@@ -0,0 +1,55 @@
+import os
+import pytest
+from ricecooker import config
+from ricecooker.managers.progress import RestoreManager, Status
+
+
+""" *********** PROGRESS FIXTURES *********** """
+@pytest.fixture
+def progress(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    manager = RestoreManager()
+    manager.init_session()
+    manager.set_channel("channel")
+    manager.set_tree("tree")
+    manager.set_files(["a.mp4", "b.mp4", "c.mp4"], [])
+    manager.set_diff(["a.mp4", "b.mp4", "c.mp4"])
+    return manager
+
+
+""" *********** PROGRESS TESTS *********** """
+def test_uploading_is_journaled(progress, monkeypatch):
+    uploaded = []
+    progress.set_uploading(uploaded)
+    snapshot_size = os.path.getsize(progress.get_restore_path())
+
+    for filename in ["a.mp4", "b.mp4"]:
+        uploaded.append(filename)
+        progress.set_uploading(uploaded)
+    progress.set_upload_offset("c.mp4", 1000)
+
+    # Changes are appended to journal instead of rewriting snapshot
+    assert os.path.getsize(progress.get_restore_path()) == snapshot_size
+    with open(progress.get_journal_path()) as handle:
+        assert len(handle.readlines()) == 3
+
+    restored = RestoreManager().load_progress(Status.LAST.name)
+    assert restored.get_status() == Status.UPLOADING_FILES
+    assert restored.files_uploaded == ["a.mp4", "b.mp4"]
+    assert restored.get_upload_offset("c.mp4") == 1000
+
+def test_journal_is_compacted(progress, monkeypatch):
+    monkeypatch.setattr(config, 'JOURNAL_SNAPSHOT_INTERVAL', 2)
+    uploaded = []
+    progress.set_uploading(uploaded)
+    for filename in ["a.mp4", "b.mp4", "c.mp4"]:
+        uploaded.append(filename)
+        progress.set_uploading(uploaded)
+
+    with open(progress.get_journal_path()) as handle:
+        assert len(handle.readlines()) == 1
+    restored = RestoreManager().load_progress(Status.LAST.name)
+    assert restored.files_uploaded == ["a.mp4", "b.mp4", "c.mp4"]
+
+    # Earlier steps can still be restored
+    assert RestoreManager().load_progress(Status.START_UPLOAD.name).files_uploaded == []
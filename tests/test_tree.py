@@ -0,0 +1,453 @@
+import json
+import logging
+import os
+import pickle
+import pytest
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from le_utils.constants import licenses
+from ricecooker import config
+from ricecooker.classes import files
+from ricecooker.classes.nodes import ChannelNode, TopicNode, DocumentNode, VideoNode
+from ricecooker.classes.files import DocumentFile, VideoFile
+from ricecooker.managers.progress import RestoreManager, Status
+from ricecooker.managers.tree import ChannelManager
+
+
+""" *********** TREE FIXTURES *********** """
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(config, 'FAILED_FILES', [])
+    monkeypatch.setattr(config, 'PROGRESS_MANAGER', RestoreManager())
+    return tmpdir
+
+@pytest.fixture
+def document_paths(workdir):
+    paths = []
+    for i in range(10):
+        path = workdir.join("document-{}.pdf".format(i))
+        path.write_binary("document {}".format(i % 5).encode('utf-8'))
+        paths.append(str(path))
+    return paths
+
+@pytest.fixture
+def channel(document_paths):
+    channel = ChannelNode(source_id="sample-channel", source_domain="learningequality.org", title="Sample Channel")
+    topic = TopicNode(source_id="topic", title="Topic")
+    channel.add_child(topic)
+    for i, path in enumerate(document_paths):
+        topic.add_child(DocumentNode(source_id="document-{}".format(i), title="Document {}".format(i), license=licenses.PUBLIC_DOMAIN, files=[DocumentFile(path)]))
+    topic.add_child(DocumentNode(source_id="missing", title="Missing", license=licenses.PUBLIC_DOMAIN, files=[DocumentFile("missing.pdf")]))
+    return channel
+
+
+""" *********** TREE TESTS *********** """
+@pytest.mark.parametrize("workers", [1, 4])
+def test_process_tree(channel, monkeypatch, workers):
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', workers)
+    filenames = ChannelManager(channel).process_tree(channel)
+
+    # Duplicate contents should map to the same file
+    assert len(filenames) == 5
+    assert all(os.path.isfile(config.get_storage_path(f)) for f in filenames)
+    assert [str(f) for f in config.FAILED_FILES] == ["missing.pdf"]
+
+    # Temporary files are moved into place or cleaned up
+    assert not [f for f in os.listdir(config.STORAGE_DIRECTORY) if os.path.isfile(os.path.join(config.STORAGE_DIRECTORY, f))]
+
+def test_spread_across_hosts(workdir):
+    hosts = ["a.org", "a.org", "a.org", "b.org", "c.org", "b.org"]
+    nodes = [DocumentNode(source_id=str(i), title=str(i), license=licenses.PUBLIC_DOMAIN,
+                files=[DocumentFile("http://{}/{}.pdf".format(host, i))]) for i, host in enumerate(hosts)]
+    assert ChannelManager(None).spread_across_hosts(nodes) == [0, 3, 4, 1, 5, 2]
+
+def test_process_tree_resolves_cache(channel, document_paths, caplog):
+    ChannelManager(channel).process_tree(channel)
+    for path in document_paths:
+        os.remove(path)
+    for f in [f for node in ChannelManager(channel).get_nodes(channel) for f in node.files]:
+        f.filename = None
+    config.FAILED_FILES = []
+
+    caplog.set_level(logging.INFO)
+    filenames = ChannelManager(channel).process_tree(channel)
+    assert len(filenames) == 5
+    assert [str(f) for f in config.FAILED_FILES] == ["missing.pdf"]
+    assert "10 file(s) found in cache, 1 file(s) to process" in caplog.text
+
+def test_process_tree_resumes(channel, document_paths, monkeypatch):
+    monkeypatch.setattr(config, 'UPDATE', True)  # Don't use cache
+    config.PROGRESS_MANAGER.init_session()
+    config.PROGRESS_MANAGER.set_channel(None)
+    config.PROGRESS_MANAGER.set_tree(None)
+    ChannelManager(channel).process_tree(channel)
+    processed = config.PROGRESS_MANAGER.files_processed
+    assert len(processed) == len(document_paths)
+
+    # Files recorded in last session are skipped even if source is no longer available
+    for path in document_paths[:5]:
+        os.remove(path)
+    config.PROGRESS_MANAGER = RestoreManager().load_progress('LAST')
+    assert config.PROGRESS_MANAGER.get_status() == Status.DOWNLOAD_FILES
+    config.FAILED_FILES = []
+    for f in [f for node in ChannelManager(channel).get_nodes(channel) for f in node.files]:
+        f.filename = None
+
+    filenames = ChannelManager(channel).process_tree(channel)
+    assert len(filenames) == 5
+    assert config.PROGRESS_MANAGER.files_processed == processed
+    assert [str(f) for f in config.FAILED_FILES] == ["missing.pdf"]
+
+
+class MockCompressor(object):
+    """ Stands in for ffmpeg, tracking how many videos are compressed at once """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = self.max_active = 0
+        self.compressed = []
+
+    def __call__(self, source, target, overwrite=False, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with open(source, 'rb') as sourcef, open(target, 'wb') as targetf:
+            targetf.write(b"compressed " + sourcef.read())
+        with self.lock:
+            self.active -= 1
+            self.compressed.append(source)
+
+def test_process_tree_compresses_in_background(workdir, monkeypatch):
+    compressor = MockCompressor()
+    monkeypatch.setattr(files, 'compress_video', compressor)
+    monkeypatch.setattr(files, 'COMPRESSION_EXECUTOR', None)
+    monkeypatch.setattr(config, 'COMPRESSION_WORKERS', 3)
+    monkeypatch.setattr(config, 'COMPRESS', True)
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', 2)
+    config.PROGRESS_MANAGER.init_session()
+    config.PROGRESS_MANAGER.set_channel(None)
+    config.PROGRESS_MANAGER.set_tree(None)
+
+    channel = ChannelNode(source_id="video-channel", source_domain="learningequality.org", title="Video Channel")
+    for i in range(6):
+        workdir.join("video-{}.mp4".format(i)).write_binary("video {}".format(i % 4).encode('utf-8'))
+        channel.add_child(VideoNode(source_id="video-{}".format(i), title="Video {}".format(i), license=licenses.PUBLIC_DOMAIN,
+            files=[VideoFile(str(workdir.join("video-{}.mp4".format(i))))]))
+
+    filenames = ChannelManager(channel).process_tree(channel)
+    assert len(filenames) == 4  # Only compressed videos are kept
+    assert all(open(config.get_storage_path(f), 'rb').read().startswith(b"compressed") for f in filenames)
+    assert len(compressor.compressed) == 4  # Duplicate videos are compressed once
+    assert compressor.max_active > 1
+    assert sorted(config.PROGRESS_MANAGER.files_processed.values()) == sorted(f.filename for n in channel.children for f in n.files)
+    assert all(f.compression is None for n in channel.children for f in n.files)
+
+
+""" *********** UPLOAD FIXTURES *********** """
+class MockResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+class MockSession(object):
+    def __init__(self, failing=None):
+        self.failing = failing or []
+        self.posted = []
+
+    def post(self, url, data=None, **kwargs):
+        filename = data.filename
+        self.posted.append(filename)
+        return MockResponse(500 if filename in self.failing else 200)
+
+class MockProgressManager(object):
+    def __init__(self):
+        self.checkpoints = []
+
+    def set_uploading(self, files_uploaded):
+        self.checkpoints.append(list(files_uploaded))
+
+@pytest.fixture
+def stored_files(workdir):
+    filenames = []
+    for i in range(12):
+        filename = "{:032x}.pdf".format(i)
+        with open(config.get_storage_path(filename), 'wb') as fobj:
+            fobj.write(b"content")
+        filenames.append(filename)
+    return filenames
+
+
+""" *********** UPLOAD TESTS *********** """
+@pytest.mark.parametrize("workers", [1, 4])
+def test_upload_files(channel, stored_files, monkeypatch, workers):
+    session = MockSession(failing=stored_files[:2])
+    progress = MockProgressManager()
+    monkeypatch.setattr(config, 'SESSION', session)
+    monkeypatch.setattr(config, 'PROGRESS_MANAGER', progress)
+    monkeypatch.setattr(config, 'UPLOAD_WORKERS', workers)
+    monkeypatch.setattr(config, 'UPLOAD_CHECKPOINT_INTERVAL', 5)
+
+    tree = ChannelManager(channel)
+    tree.uploaded_files = stored_files[-1:]  # Already uploaded in a previous session
+    tree.upload_files(stored_files)
+
+    assert sorted(session.posted) == sorted(stored_files[:-1])
+    assert sorted(tree.failed_uploads) == sorted(stored_files[:2])
+    assert sorted(tree.uploaded_files) == sorted(stored_files[2:])
+    assert [len(c) for c in progress.checkpoints] == [6, 10]
+
+
+""" *********** FILE DIFF FIXTURES *********** """
+class MockDiffResponse(object):
+    def __init__(self, content):
+        self._content = json.dumps(content).encode('utf-8')
+
+    def raise_for_status(self):
+        pass
+
+class MockDiffSession(object):
+    def __init__(self):
+        self.batch_sizes = []
+
+    def post(self, url, data=None, **kwargs):
+        chunk = json.loads(data)
+        self.batch_sizes.append(len(chunk))
+        return MockDiffResponse([f for f in chunk if int(f.split('.')[0], 16) % 3 == 0])
+
+
+""" *********** FILE DIFF TESTS *********** """
+def test_get_file_diff(channel, monkeypatch):
+    session = MockDiffSession()
+    monkeypatch.setattr(config, 'SESSION', session)
+    monkeypatch.setattr(config, 'FILE_DIFF_BATCH_SIZE', 100)
+    monkeypatch.setattr(config, 'FILE_DIFF_MIN_BATCH_SIZE', 10)
+    files_to_diff = ["{:032x}.mp4".format(i) for i in range(5000)]
+
+    file_diff = ChannelManager(channel).get_file_diff(files_to_diff)
+    assert file_diff == [f for i, f in enumerate(files_to_diff) if i % 3 == 0]
+    assert sum(session.batch_sizes) == 5000
+    assert max(session.batch_sizes) > 100  # Fast responses grow batch size
+
+def test_get_diff_batch_size(channel, monkeypatch):
+    monkeypatch.setattr(config, 'FILE_DIFF_TARGET_LATENCY', 2.0)
+    monkeypatch.setattr(config, 'FILE_DIFF_MIN_BATCH_SIZE', 100)
+    monkeypatch.setattr(config, 'FILE_DIFF_MAX_PAYLOAD', 40000)
+    tree = ChannelManager(channel)
+    chunk = ["{:032x}.mp4".format(i) for i in range(500)]
+
+    assert tree.get_diff_batch_size(500, chunk, 2.0) == 500
+    assert tree.get_diff_batch_size(500, chunk, 10.0) == 300
+    assert tree.get_diff_batch_size(150, chunk, 100.0) == 100
+    assert tree.get_diff_batch_size(500, chunk, 0.5) == len(chunk) * 40000 // len(json.dumps(chunk))
+
+
+""" *********** PIPELINE FIXTURES *********** """
+class MockPipelineSession(MockDiffSession):
+    """ Reports every other file as missing from Kolibri Studio and accepts all uploads """
+    def __init__(self):
+        super(MockPipelineSession, self).__init__()
+        self.posted = []
+
+    def post(self, url, data=None, **kwargs):
+        if url == config.file_diff_url():
+            chunk = json.loads(data)
+            self.batch_sizes.append(len(chunk))
+            return MockDiffResponse(sorted(chunk)[::2])
+        self.posted.append(data.filename)
+        return MockResponse(200)
+
+
+""" *********** PIPELINE TESTS *********** """
+def test_process_and_upload_tree(channel, monkeypatch):
+    session = MockPipelineSession()
+    monkeypatch.setattr(config, 'SESSION', session)
+    monkeypatch.setattr(config, 'DOWNLOAD_WORKERS', 4)
+    monkeypatch.setattr(config, 'UPLOAD_WORKERS', 2)
+    monkeypatch.setattr(config, 'FILE_DIFF_MIN_BATCH_SIZE', 2)
+    config.PROGRESS_MANAGER.init_session()
+    config.PROGRESS_MANAGER.set_channel(None)
+    config.PROGRESS_MANAGER.set_tree(None)
+
+    tree = ChannelManager(channel)
+    filenames, file_diff = tree.process_and_upload_tree(channel)
+    assert len(filenames) == 5
+    assert sum(session.batch_sizes) == 5  # Each file is only checked once
+    assert sorted(session.posted) == sorted(file_diff) == sorted(tree.uploaded_files)
+
+    # Uploads are recorded without leaving download step
+    progress = RestoreManager().load_progress('LAST')
+    assert progress.get_status() == Status.DOWNLOAD_FILES
+    assert sorted(progress.files_uploaded) == sorted(file_diff)
+
+
+""" *********** ADD NODES FIXTURES *********** """
+class MockAddNodesResponse(MockDiffResponse):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.reason = "Error" if status_code != 200 else "OK"
+        super(MockAddNodesResponse, self).__init__(content)
+
+class MockAddNodesSession(object):
+    def __init__(self, failing=None):
+        self.failing = failing or []
+        self.created = {}
+
+    def post(self, url, data=None, **kwargs):
+        payload = json.loads(data)
+        if payload['root_id'] in self.failing:
+            return MockAddNodesResponse(500, {})
+        root_ids = {}
+        for child in payload['content_data']:
+            root_ids[child['node_id']] = "studio-{}".format(child['node_id'])
+            self.created[root_ids[child['node_id']]] = payload['root_id']
+        return MockAddNodesResponse(200, {'root_ids': root_ids})
+
+@pytest.fixture
+def topic_tree(workdir):
+    channel = ChannelNode(source_id="sample-channel", source_domain="learningequality.org", title="Sample Channel")
+    for i in range(3):
+        topic = TopicNode(source_id="topic-{}".format(i), title="Topic {}".format(i))
+        channel.add_child(topic)
+        for j in range(3):
+            subtopic = TopicNode(source_id="topic-{}-{}".format(i, j), title="Topic {}.{}".format(i, j))
+            topic.add_child(subtopic)
+            subtopic.add_child(TopicNode(source_id="topic-{}-{}-0".format(i, j), title="Topic {}.{}.0".format(i, j)))
+    return channel
+
+
+""" *********** ADD NODES TESTS *********** """
+def test_add_nodes(topic_tree, monkeypatch):
+    session = MockAddNodesSession()
+    monkeypatch.setattr(config, 'SESSION', session)
+    ChannelManager(topic_tree).add_nodes("studio-root", topic_tree)
+
+    nodes = ChannelManager(topic_tree).get_nodes(topic_tree)[1:]
+    assert len(session.created) == len(nodes)
+    for node in nodes:
+        parent_id = "studio-root" if node.parent is topic_tree else "studio-{}".format(node.parent.get_node_id().hex)
+        assert session.created["studio-{}".format(node.get_node_id().hex)] == parent_id
+
+def test_add_nodes_failed(topic_tree, monkeypatch):
+    failed_topic = topic_tree.children[1]
+    session = MockAddNodesSession(failing=["studio-{}".format(failed_topic.get_node_id().hex)])
+    monkeypatch.setattr(config, 'SESSION', session)
+    tree = ChannelManager(topic_tree)
+    tree.add_nodes("studio-root", topic_tree)
+
+    assert [(n[0], n[1]) for n in tree.failed_node_builds] == [("studio-{}".format(failed_topic.get_node_id().hex), failed_topic)]
+    assert len(session.created) == len(tree.get_nodes(topic_tree)) - len(tree.get_nodes(failed_topic))
+
+""" *********** CHUNKED UPLOAD FIXTURES *********** """
+class ChunkUploadHandler(BaseHTTPRequestHandler):
+    """ Stand-in for a server with a file_upload_chunk endpoint (responds 404 if server.supports_chunks is False) """
+    def do_POST(self):
+        server = self.server
+        if not urlparse(self.path).path.endswith("file_upload_chunk"):
+            self.rfile.read(int(self.headers['Content-Length']))
+            server.whole_uploads += 1
+            return self.respond(200, {})
+        if not server.supports_chunks:
+            return self.respond(404, {})
+        filename = parse_qs(urlparse(self.path).query)['filename'][0]
+        start, end, total = map(int, re.match(r"bytes (\d+)-(\d+)/(\d+)", self.headers['Content-Range']).groups())
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append((filename, start))
+
+        received = server.chunks.setdefault(filename, bytearray())
+        if (filename, start) in server.fail_once:
+            server.fail_once.remove((filename, start))
+            self.respond(500, {})
+        elif start != len(received):
+            self.respond(416, {'offset': len(received)})
+        else:
+            received += data
+            if len(received) == total:
+                server.assembled[filename] = bytes(server.chunks.pop(filename))
+            self.respond(200, {'offset': len(received) if filename in server.chunks else total})
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def chunk_server(http_server, monkeypatch):
+    server = http_server(ChunkUploadHandler)
+    server.chunks, server.assembled, server.requests, server.fail_once = {}, {}, [], []
+    server.supports_chunks, server.whole_uploads = True, 0
+    monkeypatch.setattr(config, 'DOMAIN', "http://127.0.0.1:{}".format(server.server_port))
+    return server
+
+@pytest.fixture
+def large_file(workdir):
+    filename = "{:032x}.mp4".format(100)
+    content = os.urandom(2500)
+    with open(config.get_storage_path(filename), 'wb') as fobj:
+        fobj.write(content)
+    return filename, content
+
+
+""" *********** CHUNKED UPLOAD TESTS *********** """
+def test_upload_file_in_chunks_resumes(channel, chunk_server, large_file, monkeypatch):
+    filename, content = large_file
+    monkeypatch.setattr(config, 'PROGRESS_MANAGER', RestoreManager())
+    monkeypatch.setattr(config, 'CHUNKED_UPLOAD_THRESHOLD', 1000)
+    monkeypatch.setattr(config, 'UPLOAD_CHUNK_SIZE', 1000)
+    chunk_server.fail_once.append((filename, 2000))
+
+    tree = ChannelManager(channel)
+    tree.upload_files([filename])
+    assert tree.failed_uploads == [filename]
+    assert config.PROGRESS_MANAGER.get_upload_offset(filename) == 2000
+
+    # Resume from a reloaded session
+    config.PROGRESS_MANAGER = config.PROGRESS_MANAGER.load_progress('LAST')
+    tree.reattempt_upload_fails()
+    assert tree.uploaded_files == [filename]
+    assert chunk_server.assembled[filename] == content
+    assert chunk_server.requests == [(filename, 0), (filename, 1000), (filename, 2000), (filename, 2000)]
+    assert config.PROGRESS_MANAGER.get_upload_offset(filename) == 0
+
+def test_upload_file_in_chunks_restarts_from_server_offset(channel, chunk_server, large_file, monkeypatch):
+    filename, content = large_file
+    monkeypatch.setattr(config, 'PROGRESS_MANAGER', RestoreManager())
+    monkeypatch.setattr(config, 'CHUNKED_UPLOAD_THRESHOLD', 1000)
+    monkeypatch.setattr(config, 'UPLOAD_CHUNK_SIZE', 1000)
+    config.PROGRESS_MANAGER.upload_offsets[filename] = 1000  # Server doesn't have this chunk
+
+    ChannelManager(channel).upload_files([filename])
+    assert chunk_server.assembled[filename] == content
+    assert chunk_server.requests == [(filename, 1000), (filename, 0), (filename, 1000), (filename, 2000)]
+
+def test_upload_file_without_chunk_endpoint(channel, chunk_server, large_file, monkeypatch):
+    filename, content = large_file
+    monkeypatch.setattr(config, 'PROGRESS_MANAGER', RestoreManager())
+    monkeypatch.setattr(config, 'CHUNKED_UPLOAD_THRESHOLD', 1000)
+    chunk_server.supports_chunks = False
+
+    tree = ChannelManager(channel)
+    tree.upload_files([filename])
+    assert tree.uploaded_files == [filename]
+    assert chunk_server.whole_uploads == 1
+
+    # Chunking isn't attempted again once server doesn't support it
+    tree.upload_file(filename)
+    assert chunk_server.whole_uploads == 2
+
+def test_upload_file_is_whole_by_default(channel, chunk_server, large_file):
+    filename, content = large_file
+    ChannelManager(channel).upload_files([filename])
+    assert chunk_server.whole_uploads == 1
+
+def test_upload_file_in_chunks_from_older_session(channel):
+    tree = ChannelManager(channel)
+    del tree.chunked_uploads  # Sessions saved before chunked uploads existed
+    assert pickle.loads(pickle.dumps(tree)).chunked_uploads
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pytest
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler
+from cachecontrol.caches.file_cache import FileCache
+from ricecooker.utils.caching import SQLiteCache
+from ricecooker.utils.hashing import hash_file
+from ricecooker.utils.multipart import MultipartFileEncoder
+from ricecooker.utils.throttling import Throttle, ThrottledHTTPAdapter
+
+
+""" *********** MULTIPART TESTS *********** """
+def test_multipart_file_encoder(tmpdir):
+    path = tmpdir.join("abc123.mp4")
+    path.write_binary(b"0123456789" * 1000)
+
+    with open(str(path), 'rb') as fobj:
+        body = MultipartFileEncoder('file', fobj)
+        chunks = iter(lambda: body.read(1000), b"")
+        content = b"".join(chunks)
+
+    assert len(content) == len(body)
+    message = BytesParser().parsebytes(b"Content-Type: " + body.content_type.encode('utf-8') + b"\r\n\r\n" + content)
+    part, = message.get_payload()
+    assert part.get_param('name', header='content-disposition') == 'file'
+    assert part.get_filename() == "abc123.mp4"
+    assert part.get_payload(decode=True) == b"0123456789" * 1000
+
+
+""" *********** CACHE TESTS *********** """
+def test_sqlite_cache(tmpdir):
+    cache = SQLiteCache(str(tmpdir.join("cache.sqlite3")))
+    assert cache.get("DOWNLOAD:missing") is None
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.set("DOWNLOAD:{}".format(i), "{}.png".format(i).encode('utf-8')), range(100)))
+
+    values = cache.get_many(["DOWNLOAD:{}".format(i) for i in range(1000)])
+    assert len(values) == 100
+    assert values["DOWNLOAD:42"] == b"42.png"
+    cache.delete("DOWNLOAD:42")
+    assert cache.get("DOWNLOAD:42") is None
+
+def test_sqlite_cache_migrates_legacy_cache(tmpdir):
+    legacy_directory = str(tmpdir.join(".ricecookerfilecache"))
+    FileCache(legacy_directory, forever=True).set("DOWNLOAD:a.png", b"abc.png")
+    cache = SQLiteCache(str(tmpdir.join("cache.sqlite3")), legacy_directory=legacy_directory)
+    assert cache.get("DOWNLOAD:a.png") == b"abc.png"
+
+    # Value is now stored in database
+    assert SQLiteCache(str(tmpdir.join("cache.sqlite3"))).get("DOWNLOAD:a.png") == b"abc.png"
+
+
+""" *********** HASHING TESTS *********** """
+def test_hash_file(tmpdir):
+    for i, content in enumerate([b"", b"abc", os.urandom(100000)]):
+        tmpdir.join(str(i)).write_binary(content)
+        assert hash_file(str(tmpdir.join(str(i)))).hexdigest() == hashlib.md5(content).hexdigest()
+
+
+""" *********** THROTTLING TESTS *********** """
+class ThrottledHandler(BaseHTTPRequestHandler):
+    """ Responds 429 to the first server.rejections requests, tracking how many requests run at once """
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+            rejected = self.server.rejections > 0
+            self.server.rejections -= 1
+        time.sleep(0.05)
+        with self.server.lock:
+            self.server.active -= 1
+        self.send_response(429 if rejected else 200)
+        if rejected:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def throttled_server(http_server):
+    server = http_server(ThrottledHandler, threaded=True)
+    server.lock, server.active, server.max_active, server.rejections = threading.Lock(), 0, 0, 0
+    return server
+
+def test_throttled_adapter_limits_concurrency(throttled_server):
+    session = requests.Session()
+    session.mount('http://', ThrottledHTTPAdapter(throttle=Throttle(concurrency=2)))
+    url = "http://127.0.0.1:{}/".format(throttled_server.server_port)
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(executor.map(lambda i: session.get(url), range(12)))
+    assert all(r.status_code == 200 for r in responses)
+    assert throttled_server.max_active == 2
+
+def test_throttled_adapter_retries_after_429(throttled_server):
+    throttled_server.rejections = 2
+    session = requests.Session()
+    session.mount('http://', ThrottledHTTPAdapter(attempts=3))
+    assert session.get("http://127.0.0.1:{}/".format(throttled_server.server_port)).status_code == 200
+
+    throttled_server.rejections = 3
+    assert session.get("http://127.0.0.1:{}/".format(throttled_server.server_port)).status_code == 429
+
+def test_throttle_backoff_pauses_host():
+    throttle = Throttle(concurrency=1)
+    throttle.backoff("example.org", 0.2)
+    start = time.monotonic()
+    throttle.acquire("example.org")
+    throttle.release("example.org")
+    assert time.monotonic() - start >= 0.2
+    throttle.acquire("other.org") # Other hosts aren't paused
+    assert time.monotonic() - start < 0.3